@@ -6,16 +6,20 @@ Commands related to the management of the bot (but not core to functionality)
 
 import ast
 import asyncio
+import datetime
 import logging
 import random
+import time
 import traceback
+import typing
 
 import discord
 from discord.ext import commands
 
-from base import fragment, sql, resolver
+from base import config, fragment, outbound, sql, resolver
 
 setup = fragment.Fragment()
+teardown = setup.teardown
 _L = logging.getLogger(__name__)
 
 @setup.command("!sql", hidden=True)
@@ -26,7 +30,11 @@ async def sql_query(ctx, *, query):
     """
     buffered = ""
     try:
-        for row in sql.query(query):
+        if sql.is_readonly(query):
+            rows = await sql.read(query)
+        else:
+            rows = sql.query(query)
+        for row in rows:
             line = "\t".join(map(repr, row)) + "\n"
             if len(buffered) + len(line) >= 2000 - 50: # Some extra leeway
                 # flush
@@ -72,17 +80,120 @@ async def execute(ctx, *, code):
     else:
         await ctx.message.add_reaction("✅")
 
+# Discord refuses to bulk delete messages older than this
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+BULK_DELETE_CHUNK = 100
+# Concurrent single deletes, for messages too old to bulk delete
+SINGLE_DELETE_CONCURRENCY = 4
+# How far back `!purge last` will look for messages
+PURGE_SCAN_LIMIT = 5000
+
+async def delete_messages(channel: discord.TextChannel, message_ids: typing.Iterable[int]) -> int:
+    """
+    Delete messages by ID, without fetching them first.
+
+    Messages young enough are bulk deleted, up to 100 at a time. Older ones
+    are deleted one by one, a few at a time. Messages which are already gone
+    are skipped.
+
+    Returns the number of messages deleted.
+    """
+    # leave a bit of slack so messages don't age out mid-request
+    cutoff = datetime.datetime.utcnow() - BULK_DELETE_MAX_AGE + datetime.timedelta(minutes=1)
+    young, old = [], []
+    for mid in set(message_ids):
+        (young if discord.utils.snowflake_time(mid) > cutoff else old).append(mid)
+    young.sort()
+    if len(young) % BULK_DELETE_CHUNK == 1:
+        old.append(young.pop()) # bulk delete needs at least 2
+
+    deleted = 0
+    for start in range(0, len(young), BULK_DELETE_CHUNK):
+        chunk = young[start:start+BULK_DELETE_CHUNK]
+        await channel.delete_messages([discord.Object(id=mid) for mid in chunk])
+        deleted += len(chunk)
+
+    limit = asyncio.Semaphore(SINGLE_DELETE_CONCURRENCY)
+    async def delete_one(mid):
+        async with limit:
+            try:
+                await channel.delete_messages([discord.Object(id=mid)])
+            except discord.NotFound:
+                return 0
+            return 1
+    deleted += sum(await asyncio.gather(*map(delete_one, old)))
+
+    _L.info("deleted %d messages from #%s (%d bulk, %d single)",
+            deleted, channel, len(young), len(old))
+    return deleted
+
 @setup.command("!delete", hidden=True)
 @commands.is_owner()
 async def delete(ctx, *messages: int):
     """
-    Deletes a message
+    Deletes messages in this channel by ID
     """
-    for msg in messages:
-        message = await ctx.channel.fetch_message(msg)
-        await message.delete()
+    if ctx.channel.permissions_for(ctx.me).manage_messages:
+        await delete_messages(ctx.channel, messages)
+    else:
+        # Only our own messages (e.g. in DMs), which can't be bulk deleted
+        for msg in messages:
+            message = await ctx.channel.fetch_message(msg)
+            await message.delete()
     await ctx.message.add_reaction("✅")
 
+async def purge_history(channel, history, predicate=lambda msg: True, limit=None) -> int:
+    """
+    Delete messages matching a predicate from a history iterator, a page at a
+    time as we go
+    """
+    batch = []
+    deleted = 0
+    matched = 0
+    async for msg in history:
+        if not predicate(msg):
+            continue
+        batch.append(msg.id)
+        matched += 1
+        if len(batch) >= BULK_DELETE_CHUNK:
+            deleted += await delete_messages(channel, batch)
+            batch = []
+        if limit is not None and matched >= limit:
+            break
+    deleted += await delete_messages(channel, batch)
+    return deleted
+
+@setup.group("!purge", hidden=True, invoke_without_command=True)
+@commands.bot_has_permissions(manage_messages=True, read_message_history=True)
+@commands.is_owner()
+async def purge(ctx, from_id: int, to_id: int):
+    """
+    Delete all messages in this channel between two message IDs, inclusive
+    """
+    from_id, to_id = sorted((from_id, to_id))
+    history = ctx.channel.history(
+        limit=None, oldest_first=True,
+        after=discord.Object(id=from_id - 1),
+        before=discord.Object(id=to_id + 1))
+    count = await purge_history(ctx.channel, history)
+    await ctx.send(f"\u200b:wastebasket: deleted {count} messages", delete_after=10)
+
+@purge.command("last")
+@commands.bot_has_permissions(manage_messages=True, read_message_history=True)
+@commands.is_owner()
+async def purge_last(ctx, count: int, user: commands.UserConverter = None):
+    """
+    Delete the last `count` messages in this channel, optionally only those by
+    a given user
+    """
+    history = ctx.channel.history(limit=PURGE_SCAN_LIMIT, before=ctx.message)
+    if user is None:
+        predicate = lambda msg: True
+    else:
+        predicate = lambda msg: msg.author.id == user.id
+    deleted = await purge_history(ctx.channel, history, predicate, limit=count)
+    await ctx.send(f"\u200b:wastebasket: deleted {deleted} messages", delete_after=10)
+
 @setup.command("!chatlog", hidden=True)
 @commands.bot_has_permissions(read_message_history=True)
 @commands.is_owner()
@@ -104,6 +215,7 @@ async def chatlog(ctx, *, channel: commands.TextChannelConverter = None):
     logcount = 0
 
     pending = await ctx.send("pending...")
+    progress = None
     async with ctx.channel.typing():
         async for msg in channel.history(limit=None, oldest_first=True):
             created = msg.created_at.strftime("%y-%m-%d %H:%M:%S")
@@ -123,10 +235,15 @@ async def chatlog(ctx, *, channel: commands.TextChannelConverter = None):
             logcount += len(encoded)
 
             if msgcount % 500 == 0:
-                await pending.edit(content=f"{msgcount} processed, up to {created}", suppress=False)
+                # Queued behind anything interactive, and only the latest
+                # progress is sent if we get ahead of the rate limit
+                progress = outbound.edit(pending, content=f"{msgcount} processed, up to {created}",
+                                         suppress=False)
 
         log += compress.flush()
 
+    if progress is not None:
+        progress.cancel()
     await pending.delete()
     msg = await ctx.send(
         f"{ctx.author.mention} {charcount} characters across {msgcount} messages. "
@@ -135,6 +252,61 @@ async def chatlog(ctx, *, channel: commands.TextChannelConverter = None):
 
     await ctx.author.send(f"chatlog done -> {msg.jump_url}")
 
+def reload_config() -> str:
+    """
+    Reload the config, describing what happened
+    """
+    try:
+        changed = config.reload()
+    except Exception as err: # pylint: disable=broad-except
+        _L.exception("failed to reload config")
+        return f"config not reloaded: {err}"
+    if changed:
+        return f"config reloaded, applied changes to {', '.join(changed)}"
+    return "config reloaded"
+
+@setup.command("!reconfig", hidden=True)
+@commands.is_owner()
+async def reconfig(ctx):
+    """
+    Reload config.yaml and secrets.yaml
+    """
+    await ctx.send(f"\u200b:gear: {reload_config()}", delete_after=30)
+
+@setup.command("!reload", hidden=True)
+@commands.is_owner()
+async def reload_fragment(ctx, name: str):
+    """
+    Reload a fragment from its source (and the fragments which use it),
+    without restarting the bot
+    """
+    started = time.monotonic()
+    try:
+        reloaded = fragment.reload(ctx.bot, name)
+    except commands.ExtensionError as err:
+        _L.exception("failed to reload %s", name)
+        await ctx.send(f"\u200b:x: {err}")
+        return
+    took = (time.monotonic() - started) * 1000
+    _L.info("reloaded %s in %.0fms", ", ".join(reloaded), took)
+    await ctx.send(f"\u200b:recycle: reloaded {', '.join(reloaded)} in {took:.0f}ms", delete_after=30)
+
+@setup.task
+async def config_watcher():
+    """
+    Reload the config when its files are edited
+    """
+    seen = config.mtimes()
+    while config.get("reload.watch_seconds"):
+        await asyncio.sleep(config.get("reload.watch_seconds"))
+        try:
+            now = config.mtimes()
+        except OSError:
+            continue # in the middle of being replaced
+        if now != seen:
+            seen = now
+            _L.info(reload_config())
+
 @setup.command("whois")
 async def whois(ctx, *, userid: int):
     """
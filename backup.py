@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+Online backups of the database.
+
+Snapshots are copied with SQLite's backup API in a worker thread, a few pages
+at a time (see sql.backup), so the bot carries on as normal meanwhile. Each
+snapshot is checked with `PRAGMA integrity_check` before it's gzipped, and
+only the newest few are kept.
+
+Backups are taken every so often, and on request with `!backup`.
+"""
+
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import time
+import typing
+
+from discord.ext import commands
+
+from base import config, fragment, outbound, sql
+
+setup = fragment.Fragment()
+teardown = setup.teardown
+_L = logging.getLogger(__name__)
+
+# How often `!backup` updates its progress message
+PROGRESS_SECONDS = 5
+
+class BackupFailed(Exception):
+    pass
+
+class Progress:
+    """
+    How far along a backup is, updated from its worker thread
+    """
+
+    def __init__(self):
+        self.stage = "starting"
+        self.copied = 0
+        self.total = 0
+
+    def copying(self, copied: int, total: int):
+        self.stage = "copying"
+        self.copied = copied
+        self.total = total
+
+    def __str__(self):
+        if self.stage == "copying" and self.total:
+            return f"copying, {self.copied}/{self.total} pages ({100 * self.copied // self.total}%)"
+        return self.stage
+
+def _directory() -> pathlib.Path:
+    return pathlib.Path(config.get("backup.path"))
+
+def _name(stamp: str) -> str:
+    return f"{pathlib.Path(config.get('sql.path')).stem}-{stamp}.db.gz"
+
+def snapshots() -> typing.List[pathlib.Path]:
+    """
+    Backups on disk, oldest first
+    """
+    return sorted(_directory().glob(_name("*")))
+
+def take_backup(progress: Progress) -> pathlib.Path:
+    """
+    Copy, check and compress a snapshot, then remove old ones. This blocks,
+    so run it in a worker thread.
+    """
+    directory = _directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    final = directory / _name(stamp)
+    copy = directory / f"{final.name}.copy.partial"
+    packed = directory / f"{final.name}.partial"
+
+    try:
+        sql.backup(str(copy),
+                   pages=config.get("backup.step_pages"),
+                   pause=config.get("backup.step_pause_ms") / 1000,
+                   progress=progress.copying)
+
+        progress.stage = "checking"
+        con = sqlite3.connect(str(copy))
+        try:
+            problems = [row[0] for row in con.execute("PRAGMA integrity_check")]
+        finally:
+            con.close()
+        if problems != ["ok"]:
+            raise BackupFailed(f"integrity check failed: {'; '.join(problems[:5])}")
+
+        progress.stage = "compressing"
+        with open(copy, "rb") as src, gzip.open(packed, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(packed, final)
+    finally:
+        for partial in (copy, packed):
+            if partial.exists():
+                partial.unlink()
+
+    for stale in snapshots()[:-config.get("backup.keep")]:
+        _L.info("removing old backup %s", stale)
+        stale.unlink()
+    progress.stage = "done"
+    return final
+
+# The backup in progress, if any
+_CURRENT: typing.Optional[typing.Tuple[Progress, asyncio.Future]] = None
+
+def start() -> typing.Tuple[Progress, asyncio.Future]:
+    """
+    Start a backup, or join the one already running
+    """
+    global _CURRENT # pylint: disable=global-statement
+    if _CURRENT is None or _CURRENT[1].done():
+        progress = Progress()
+        loop = asyncio.get_event_loop()
+        _CURRENT = (progress, loop.run_in_executor(None, take_backup, progress))
+    return _CURRENT
+
+@setup.task
+async def scheduled_backups():
+    """
+    Back up every `backup.interval_hours`, counting from the last backup
+    """
+    interval = config.get("backup.interval_hours") * 60 * 60
+    if not interval:
+        return
+    while True:
+        existing = snapshots()
+        since = time.time() - existing[-1].stat().st_mtime if existing else interval
+        await asyncio.sleep(max(0, interval - since))
+
+        started = time.monotonic()
+        try:
+            path = await start()[1]
+        except Exception: # pylint: disable=broad-except
+            _L.exception("backup failed")
+            await asyncio.sleep(interval) # don't retry straight away
+        else:
+            _L.info("backed up to %s in %.1fs", path, time.monotonic() - started)
+
+@setup.command("!backup", hidden=True)
+@commands.is_owner()
+async def backup_now(ctx):
+    """
+    Back up the database now, showing progress
+    """
+    progress, done = start()
+    pending = await ctx.send(f"\u200b:floppy_disk: backup {progress}")
+    update = None
+    while not done.done():
+        await asyncio.wait([done], timeout=PROGRESS_SECONDS)
+        if not done.done():
+            update = outbound.edit(pending, content=f"\u200b:floppy_disk: backup {progress}")
+
+    if update is not None:
+        update.cancel()
+    try:
+        path = done.result()
+    except Exception as err: # pylint: disable=broad-except
+        _L.exception("backup failed")
+        await pending.edit(content=f"\u200b:x: backup failed: {err}")
+    else:
+        size = path.stat().st_size
+        await pending.edit(content=f"\u200b:floppy_disk: backed up to `{path}` ({size // 1000} kb)")
@@ -1,44 +1,178 @@
 #!/usr/bin/env python3
 
 import asyncio
+import collections
 import contextvars
+import time
+import typing
 
-class ARLock:
+class LockUpgradeError(RuntimeError):
+    """
+    Raised when trying to take the write side of an RWLock while holding the
+    read side, which would otherwise deadlock.
     """
-    An async reentrant lock -- locking while inside the lock doesn't cause
-    deadlock.
 
-    This lock is also an async context manager.
+class RWLock:
+    """
+    An async reentrant reader/writer lock. Any number of readers can hold the
+    lock at once, or a single writer.
+
+    Reentrancy is tracked per context, so taking either side of the lock
+    while holding the write side is fine, as is reading while reading.
+    Writing while reading raises LockUpgradeError.
+
+    Waiting writers are preferred over new readers, so a steady stream of
+    readers can't starve writers out.
+
+    Use `lock.read()` and `lock.write()` as async context managers.
     """
     def __init__(self):
-        self._ctxcount = contextvars.ContextVar("ARLock._ctxcount", default=0)
-        self._lock = asyncio.Lock()
+        # (mode, depth) held by the current context
+        self._ctxheld = contextvars.ContextVar("RWLock._ctxheld", default=(None, 0))
+        self._readers = 0
+        self._writer = False
+        self._read_waiters = collections.deque()
+        self._write_waiters = collections.deque()
+
+        self._acquisitions = 0
+        self._contended = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def held(self) -> typing.Optional[str]:
+        """
+        Which side of the lock ("read" or "write") the current context holds,
+        if any
+        """
+        return self._ctxheld.get()[0]
+
+    def stats(self) -> dict:
+        """
+        Contention statistics, for diagnostics
+        """
+        return {
+            "acquisitions": self._acquisitions,
+            "contended": self._contended,
+            "wait_total": self._wait_total,
+            "wait_max": self._wait_max,
+            "holders": 1 if self._writer else self._readers,
+            "writer": self._writer,
+            # cancelled waiters can linger until they're next looked at
+            "queued_readers": sum(not fut.done() for fut in self._read_waiters),
+            "queued_writers": sum(not fut.done() for fut in self._write_waiters),
+        }
+
+    def _wake(self):
+        """
+        Hand the lock to whoever should get it next
+        """
+        if self._writer:
+            return
+        # skip waiters which were cancelled, but haven't run to notice yet
+        while self._write_waiters and self._write_waiters[0].done():
+            self._write_waiters.popleft()
+        if self._write_waiters:
+            if self._readers == 0:
+                fut = self._write_waiters.popleft()
+                self._writer = True
+                fut.set_result(None)
+            # don't let new readers in ahead of a waiting writer
+            return
+        while self._read_waiters:
+            fut = self._read_waiters.popleft()
+            if not fut.done():
+                self._readers += 1
+                fut.set_result(None)
+
+    def _release_shared(self, mode: str):
+        if mode == "write":
+            self._writer = False
+        else:
+            self._readers -= 1
+        self._wake()
+
+    async def _wait(self, waiters: collections.deque, mode: str):
+        fut = asyncio.get_event_loop().create_future()
+        waiters.append(fut)
+        start = time.monotonic()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # we were given the lock just as we got cancelled, so pass
+                # it on
+                self._release_shared(mode)
+            else:
+                if fut in waiters:
+                    waiters.remove(fut)
+                # a waiting writer may have been holding readers back
+                self._wake()
+            raise
+        waited = time.monotonic() - start
+        self._contended += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
 
-    async def acquire(self):
+    async def acquire(self, mode: str):
         """
-        Acquires the lock. This shouldn't usually be used -- use the lock as a
-        context manager instead.
+        Acquires the lock in a given mode ("read" or "write"). This shouldn't
+        usually be used -- use read() or write() instead.
         """
-        count = self._ctxcount.get()
-        if count == 0:
-            # we gotta lock
-            await self._lock.acquire()
-        self._ctxcount.set(count+1)
+        held, depth = self._ctxheld.get()
+        if held == "write" or (held == "read" and mode == "read"):
+            self._ctxheld.set((held, depth + 1))
+            return
+        if held == "read":
+            raise LockUpgradeError("cannot take write lock while holding read lock")
+
+        if mode == "write":
+            if not self._writer and self._readers == 0 and not self._write_waiters:
+                self._writer = True
+            else:
+                await self._wait(self._write_waiters, mode)
+        else:
+            if not self._writer and not self._write_waiters:
+                self._readers += 1
+            else:
+                await self._wait(self._read_waiters, mode)
+
+        self._acquisitions += 1
+        self._ctxheld.set((mode, 1))
 
     def release(self):
         """
-        Releases the lock. This shouldn't usually be used -- use the lock as a
-        context manager instead.
+        Releases the lock. This shouldn't usually be used -- use read() or
+        write() instead.
         """
-        count = self._ctxcount.get()
-        if count <= 0:
+        held, depth = self._ctxheld.get()
+        if held is None:
             raise RuntimeError("cannot release un-acquired lock")
-        if count == 1:
-            self._lock.release()
-        self._ctxcount.set(count - 1)
+        if depth == 1:
+            self._ctxheld.set((None, 0))
+            self._release_shared(held)
+        else:
+            self._ctxheld.set((held, depth - 1))
+
+    def read(self) -> "_RWGuard":
+        """
+        Context manager for the read side of the lock
+        """
+        return _RWGuard(self, "read")
+
+    def write(self) -> "_RWGuard":
+        """
+        Context manager for the write side of the lock
+        """
+        return _RWGuard(self, "write")
+
+class _RWGuard:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, lock: RWLock, mode: str):
+        self._lock = lock
+        self._mode = mode
 
     async def __aenter__(self):
-        await self.acquire()
+        await self._lock.acquire(self._mode)
 
     async def __aexit__(self, _exc_type, _exc, _tb):
-        self.release()
+        self._lock.release()
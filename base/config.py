@@ -2,24 +2,144 @@
 
 """
 Handle global configuration relevant to the base layer only
+
+config.yaml and secrets.yaml (under "secrets") are read into an immutable
+snapshot, which `reload` swaps for a new one in one go, so readers never see
+half of a change. Code that cares about a section changing (e.g. to rebuild
+something made from it) registers with `on_change`.
+
+`get` looks keys up through `Key` handles, which split the dotted key once
+and only walk the snapshot again after a reload. Hot paths can hold on to a
+handle from `key` themselves.
 """
 
 import logging
+import os
+import types
+import typing
+
 import yaml
 
 _L = logging.getLogger(__name__)
 
-with open("config.yaml") as config_file:
-    CONFIG = yaml.load(config_file, Loader=yaml.FullLoader)
+# libyaml's loader is much faster, where it's installed
+_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+
+FILES = ("config.yaml", "secrets.yaml")
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def thaw(value):
+    """
+    A mutable copy of part of the config, for things which need plain dicts
+    and lists (e.g. logging.config.dictConfig)
+    """
+    if isinstance(value, types.MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+def _load() -> types.MappingProxyType:
+    with open("config.yaml") as config_file:
+        config = yaml.load(config_file, Loader=_LOADER)
+    with open("secrets.yaml") as secrets_file:
+        config["secrets"] = yaml.load(secrets_file, Loader=_LOADER)
+    return _freeze(config)
+
+def mtimes() -> typing.Tuple[float, ...]:
+    """
+    When the config files were last changed, for noticing edits
+    """
+    return tuple(os.stat(name).st_mtime for name in FILES)
 
-with open("secrets.yaml") as secrets_file:
-    CONFIG["secrets"] = yaml.load(secrets_file, Loader=yaml.FullLoader)
+# (generation, snapshot), swapped as one
+_CURRENT = (0, _load())
 
-def get(key: str):
+class Key:
+    """
+    A handle for one config key, which is only looked up again after a
+    reload
+    """
+
+    __slots__ = ("name", "path", "_generation", "_value")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.path = tuple(name.split("."))
+        self._generation = -1
+        self._value = None
+
+    def get(self):
+        generation, snapshot = _CURRENT
+        if self._generation != generation:
+            head = snapshot
+            for seg in self.path:
+                head = head[seg]
+            self._value = head
+            self._generation = generation
+        return self._value
+
+_KEYS: typing.Dict[str, Key] = {}
+
+def key(name: str) -> Key:
+    """
+    The handle for a config key
+    """
+    handle = _KEYS.get(name)
+    if handle is None:
+        handle = _KEYS[name] = Key(name)
+    return handle
+
+def get(name: str):
     """
     Get a config key
     """
-    head = CONFIG
-    for seg in key.split("."):
-        head = head[seg]
-    return head
+    return key(name).get()
+
+# Keyed by key and function, so a module that's reloaded replaces its own
+_WATCHERS: typing.Dict[typing.Tuple[str, str], typing.Tuple[Key, typing.Callable]] = {}
+
+def on_change(name: str):
+    """
+    Decorator - call `func(value)` after a reload changes a config key
+    """
+    def decorate(func):
+        _WATCHERS[name, f"{func.__module__}.{func.__qualname__}"] = (key(name), func)
+        return func
+    return decorate
+
+def reload() -> typing.List[str]:
+    """
+    Read the config files again, and swap in what they say if they parse.
+    Returns the keys (with watchers) that changed.
+    """
+    global _CURRENT # pylint: disable=global-statement
+    fresh = _load()
+    before = [(handle, func, _lookup(handle)) for handle, func in _WATCHERS.values()]
+    _CURRENT = (_CURRENT[0] + 1, fresh)
+    _L.info("reloaded config")
+
+    changed = []
+    for handle, func, old in before:
+        new = _lookup(handle)
+        if new == old:
+            continue
+        if handle.name not in changed:
+            changed.append(handle.name)
+        try:
+            func(new)
+        except Exception: # pylint: disable=broad-except
+            _L.exception("failed to apply change to config %s", handle.name)
+    return changed
+
+def _lookup(handle: Key):
+    try:
+        return handle.get()
+    except (KeyError, TypeError):
+        return None
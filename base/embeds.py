@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""
+Build embeds which fit within Discord's limits, splitting across as few
+messages as possible.
+"""
+
+import asyncio
+import logging
+import typing
+
+import discord
+from discord.ext import commands
+
+from . import outbound
+
+_L = logging.getLogger(__name__)
+
+# Discord's embed limits
+MAX_TITLE = 256
+MAX_DESCRIPTION = 4096
+MAX_FIELDS = 25
+MAX_FIELD_NAME = 256
+MAX_FIELD_VALUE = 1024
+MAX_FOOTER = 2048
+MAX_TOTAL = 6000
+
+# Room kept in each embed for a "page x/y" footer
+_PAGE_FOOTER = 32
+
+PREV = "◀"
+NEXT = "▶"
+
+Field = typing.Tuple[str, str, bool]
+
+def truncate(text: str, limit: int) -> str:
+    """
+    Shorten text to fit a limit, marking that it was cut
+    """
+    text = str(text)
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def split_lines(text: str, limit: int) -> typing.List[str]:
+    """
+    Split text into chunks of at most `limit` chars, on line boundaries where
+    possible
+    """
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+def pack(
+        title: str = "",
+        *,
+        description: str = "",
+        fields: typing.Iterable[Field] = (),
+        footer: str = "",
+        **kwargs
+    ) -> typing.List[discord.Embed]:
+    """
+    Build as few embeds as possible holding a title, description and fields.
+
+    Long descriptions are split on lines, and fields are packed against the
+    field count and total length limits. Names and values which are too long
+    on their own are truncated. Extra keyword arguments (e.g. colour) are
+    passed to every discord.Embed.
+    """
+    title = truncate(title, MAX_TITLE)
+    footer = truncate(footer, MAX_FOOTER - _PAGE_FOOTER)
+    overhead = len(title) + len(footer) + _PAGE_FOOTER
+    room = MAX_TOTAL - overhead
+
+    def new(desc=""):
+        embed = discord.Embed(title=title, description=desc or discord.Embed.Empty, **kwargs)
+        if footer:
+            embed.set_footer(text=footer)
+        return embed
+
+    embeds = []
+    size = 0
+    for chunk in split_lines(description, min(MAX_DESCRIPTION, room)) if description else []:
+        embeds.append(new(chunk))
+        size = len(chunk)
+
+    for name, value, inline in fields:
+        name = truncate(name or "\u200b", MAX_FIELD_NAME)
+        value = truncate(value or "\u200b", MAX_FIELD_VALUE)
+        cost = len(name) + len(value)
+        if not embeds or len(embeds[-1].fields) >= MAX_FIELDS or size + cost > room:
+            embeds.append(new())
+            size = 0
+        embeds[-1].add_field(name=name, value=value, inline=inline)
+        size += cost
+
+    return embeds or [new()]
+
+async def send(
+        dest: discord.abc.Messageable,
+        embeds: typing.List[discord.Embed],
+        *,
+        paginate: bool = False,
+        timeout: float = 120,
+        bot: typing.Optional[commands.Bot] = None,
+        priority: outbound.Priority = outbound.Priority.INTERACTIVE,
+        **kwargs
+    ) -> discord.Message:
+    """
+    Send packed embeds, one per message.
+
+    With `paginate`, only one message is sent, and reacting to it flips
+    between pages by editing it in place. This needs `bot` (or a Context for
+    `dest`). Sends go through the outbound scheduler at `priority`. Extra
+    keyword arguments (e.g. delete_after) go to every send.
+    """
+    bot = bot or getattr(dest, "bot", None) # contexts
+
+    if not paginate or len(embeds) == 1:
+        for embed in embeds:
+            message = await outbound.send(dest, embed=embed, priority=priority, **kwargs)
+        return message
+
+    # Copies, since callers may keep the embeds around and send them again
+    embeds = [embed.copy() for embed in embeds]
+    footers = [embed.footer.text or "" for embed in embeds]
+    def with_page(idx):
+        embed = embeds[idx]
+        page = f"page {idx + 1}/{len(embeds)}"
+        embed.set_footer(text=f"{footers[idx]} • {page}" if footers[idx] else page)
+        return embed
+
+    message = await outbound.send(dest, embed=with_page(0), priority=priority, **kwargs)
+    await outbound.react(message, PREV, priority=priority)
+    await outbound.react(message, NEXT, priority=priority)
+    asyncio.ensure_future(_paginate(bot, message, embeds, with_page, timeout))
+    return message
+
+async def _paginate(bot, message, embeds, with_page, timeout):
+    """
+    Flip pages on reactions until nobody has for a while
+    """
+    page = 0
+    def check(reaction, user):
+        return (reaction.message.id == message.id and user.id != bot.user.id
+                and str(reaction.emoji) in (PREV, NEXT))
+
+    while True:
+        try:
+            reaction, user = await bot.wait_for("reaction_add", check=check, timeout=timeout)
+        except asyncio.TimeoutError:
+            return
+        step = 1 if str(reaction.emoji) == NEXT else -1
+        page = (page + step) % len(embeds)
+        try:
+            await outbound.edit(message, embed=with_page(page),
+                                priority=outbound.Priority.INTERACTIVE)
+            await message.remove_reaction(reaction.emoji, user)
+        except discord.NotFound:
+            return # deleted from under us
+        except discord.Forbidden:
+            pass # can't remove others' reactions; flipping still works
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import asyncio
+import collections
 import logging
+import types
+import typing
 
 from discord.ext import commands
 
@@ -16,15 +19,228 @@ async def is_admin_or_owner(ctx: commands.Context):
     perms = ctx.channel.permissions_for(ctx.author)
     return perms.administrator
 
+def dependents(bot: commands.Bot, name: str) -> typing.List[str]:
+    """
+    Loaded extensions which import the extension `name`, directly or through
+    each other
+    """
+    names = {name}
+    found = []
+    grown = True
+    while grown:
+        grown = False
+        for ext, module in bot.extensions.items():
+            if ext in names:
+                continue
+            if any(isinstance(value, types.ModuleType) and value.__name__ in names
+                   for value in vars(module).values()):
+                names.add(ext)
+                found.append(ext)
+                grown = True
+    return found
+
+def reload(bot: commands.Bot, name: str) -> typing.List[str]:
+    """
+    Reload an extension from its source, then the extensions which import it
+    so they don't keep using the old module. Returns what was reloaded.
+
+    Only the extensions themselves are imported again; the base layer (and
+    its caches, connections, rate limits etc.) carries on as it was.
+    """
+    reloaded = [name] + dependents(bot, name)
+    for ext in reloaded:
+        bot.reload_extension(ext)
+    return reloaded
+
+class _Job:
+    def __init__(self, bot, event, func, args):
+        self.bot = bot
+        self.event = event
+        self.func = func
+        self.args = args
+        self.running = False
+        self.future = asyncio.get_event_loop().create_future()
+
+class Dispatch:
+    """
+    A dispatch policy for listeners: instead of a task per event, events go
+    onto a bounded queue and are handled by a fixed number of workers.
+
+    Events with the same key (from `key(*args)`, e.g. a message id) are
+    handled one at a time, in the order they arrived. Without `key`, events
+    are unordered.
+
+    With `coalesce`, an event replaces one for the same listener and key
+    which is still queued, for listeners where only the latest matters.
+    With `block`, events which arrive while the queue is full wait for room
+    (in the order they arrived), for listeners which mustn't miss any, up to
+    `waiters` of them (by default, `limit`). Otherwise, they're dropped.
+    Share one policy between listeners that need ordering with each other.
+    """
+
+    def __init__(self, name: str, *,
+                 workers: int = 4,
+                 limit: int = 1000,
+                 key: typing.Optional[typing.Callable[..., typing.Hashable]] = None,
+                 coalesce: bool = False,
+                 block: bool = False,
+                 waiters: typing.Optional[int] = None):
+        self.name = name
+        self.workers = workers
+        self.limit = limit
+        self.key = key
+        self.coalesce = coalesce
+        self.block = block
+        self.waiters = limit if waiters is None else waiters
+
+        self.pending = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+
+        self._queues: typing.Dict[typing.Hashable, collections.deque] = {}
+        self._ready: typing.Optional[asyncio.Queue] = None
+        self._tasks: typing.List[asyncio.Task] = []
+        # With `block`: events waiting for room, and room promised to those
+        # woken but not yet queued
+        self._waiting: typing.Deque[asyncio.Future] = collections.deque()
+        self._reserved = 0
+
+    async def room(self) -> bool:
+        """
+        With `block`, wait until there's room to queue an event, in turn
+        with any others already waiting. False if too many are waiting
+        already, and the event should be dropped.
+        """
+        if not self.block or (not self._waiting and self.pending + self._reserved < self.limit):
+            return True
+        if len(self._waiting) >= self.waiters:
+            return False
+        fut = asyncio.get_event_loop().create_future()
+        self._waiting.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # given room just as we got cancelled, so pass it on
+                self._reserved -= 1
+                self._make_room()
+            elif fut in self._waiting:
+                self._waiting.remove(fut)
+            raise
+        self._reserved -= 1
+        return True
+
+    def _make_room(self):
+        while self._waiting and self.pending + self._reserved < self.limit:
+            fut = self._waiting.popleft()
+            if not fut.done():
+                self._reserved += 1
+                fut.set_result(None)
+
+    def put(self, bot, event: str, func, args) -> asyncio.Future:
+        """
+        Queue a call of a listener, returning a future for when it's done
+        """
+        key = self.key(*args) if self.key is not None else object()
+        queue = self._queues.get(key)
+
+        if self.coalesce and queue:
+            for job in queue:
+                if job.func is func and not job.running:
+                    job.args = args
+                    self.coalesced += 1
+                    return job.future
+
+        if self.pending >= self.limit:
+            return self.drop()
+
+        if self._ready is None:
+            self.closed = False
+            self._ready = asyncio.Queue()
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+        job = _Job(bot, event, func, args)
+        if queue is None:
+            # Nothing queued or running for this key
+            queue = self._queues[key] = collections.deque()
+            self._ready.put_nowait(key)
+        queue.append(job)
+        self.pending += 1
+        return job.future
+
+    def drop(self) -> asyncio.Future:
+        """
+        Count an event as dropped, returning an already done future
+        """
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            _L.warning("dispatch %s: queue full, %d events dropped so far",
+                       self.name, self.dropped)
+        done = asyncio.get_event_loop().create_future()
+        done.set_result(None)
+        return done
+
+    async def _worker(self):
+        ready = self._ready
+        while True:
+            key = await ready.get()
+            queue = self._queues[key]
+            job = queue[0]
+            job.running = True
+            try:
+                await job.func(*job.args)
+            except asyncio.CancelledError:
+                raise
+            except Exception: # pylint: disable=broad-except
+                try:
+                    await job.bot.on_error(job.event, *job.args)
+                except Exception: # pylint: disable=broad-except
+                    _L.exception("dispatch %s: error handling %s", self.name, job.event)
+            finally:
+                queue.popleft()
+                self.pending -= 1
+                self._make_room()
+                if not job.future.done():
+                    job.future.set_result(None)
+                # Only one job per key is ever running, so the next one
+                # becomes ready once this one's done
+                if queue:
+                    ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+                if self.closed and not self.pending:
+                    self._stop()
+
+    def close(self):
+        """
+        Stop the workers once they've handled what's already queued. Using
+        the policy again starts new ones.
+        """
+        self.closed = True
+        if not self.pending:
+            self._stop()
+
+    def _stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._ready = None
+        self._tasks = []
+
 class Fragment(commands.GroupMixin):
     """
     An interface to the actual bot
+
+    A fragment keeps track of everything it attaches, so it can be detached
+    again with `teardown`. Modules export that next to `setup`, so they can
+    be unloaded and reloaded with the bot's extension machinery.
     """
 
     def __init__(self):
         commands.GroupMixin.__init__(self)
         self.events = []
-        self.tasks = []
+        self.tasks: typing.Set[asyncio.Future] = set()
+        self.dispatches: typing.List[Dispatch] = []
         self.bot = None
 
     def __call__(self, bot: commands.Bot):
@@ -44,22 +260,85 @@ class Fragment(commands.GroupMixin):
 
         for func, name in self.events:
             if name == "task":
-                bot.loop.create_task(func())
-            else:
+                self.spawn(func())
+            elif name != "teardown":
                 bot.add_listener(func, name)
 
-    def listen(self, name=None):
+    def teardown(self, bot: commands.Bot):
+        """
+        Detach a fragment from a bot, cancelling its tasks (including those
+        from `spawn`)
+        """
+        _L.debug("Fragment.teardown: bot=%s; %d commands, %d events, %d tasks",
+                 bot, len(self.commands), len(self.events), len(self.tasks))
+
+        for task in list(self.tasks):
+            task.cancel()
+
+        for dispatch in self.dispatches:
+            dispatch.close()
+
+        for func, name in self.events:
+            if name == "teardown":
+                # Called synchronously by discord.py, so async ones go in a
+                # task of their own
+                result = func()
+                if asyncio.iscoroutine(result):
+                    bot.loop.create_task(result)
+            elif name != "task":
+                bot.remove_listener(func, name)
+
+        for com in self.commands:
+            if bot.all_commands.get(com.name) is com:
+                bot.remove_command(com.name)
+
+        self.bot = None
+
+    def spawn(self, coro) -> asyncio.Future:
+        """
+        Run a coroutine in a task which is cancelled if the fragment is
+        detached first. Once detached (e.g. for events still queued when it
+        was), it's not run at all.
+        """
+        if self.bot is None:
+            coro.close()
+            task = asyncio.get_event_loop().create_future()
+            task.cancel()
+            return task
+        task = self.bot.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def listen(self, name=None, *, dispatch: typing.Optional[Dispatch] = None):
         """
         Decorator - set the event handler. If name is "task", then attach as
-        task.
+        task. If name is "teardown", then call it when the fragment is
+        detached, after its tasks are cancelled.
+
+        With `dispatch`, events are queued on that policy rather than each
+        getting their own task, and the listener attached to the bot returns
+        a future for when the event has been handled.
         """
         def decorate(func):
+            handler = func
             if name == "task" and not asyncio.iscoroutinefunction(func):
                 orig = func
                 async def afunc(bot):
                     orig(bot)
-                func = afunc
-            self.events.append((func, name))
+                handler = func = afunc
+            if dispatch is not None:
+                event = (name or func.__name__)[3:]
+                async def enqueue(*args):
+                    if not await dispatch.room():
+                        return dispatch.drop()
+                    return dispatch.put(self.bot, event, func, args)
+                enqueue.__name__ = func.__name__
+                handler = enqueue
+                if dispatch not in self.dispatches:
+                    self.dispatches.append(dispatch)
+            self.events.append((handler, name))
+            return func
         return decorate
 
     def task(self, func):
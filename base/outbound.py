@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+"""
+Schedule outbound requests (sends, edits, reactions) by priority.
+
+Requests go through a token bucket per route (e.g. sending to one channel)
+and one for the whole bot. While both have room, requests go out straight
+away. Once either runs dry, requests queue up per route and are let out
+highest priority first. That holds across routes for the global bucket too:
+while a request is waiting on it, lower priorities on other routes don't
+take from it. Lower priorities also leave some of the global bucket spare,
+so interactive replies stay quick while background work is running.
+
+Queued edits to the same message are coalesced, so only the latest content
+is sent.
+"""
+
+import asyncio
+import collections
+import enum
+import heapq
+import itertools
+import logging
+import time
+import typing
+
+import discord
+
+from . import config
+
+_L = logging.getLogger(__name__)
+
+class Priority(enum.IntEnum):
+    """
+    Lower goes first
+    """
+    INTERACTIVE = 0
+    PINBOARD = 1
+    BACKGROUND = 2
+
+Route = typing.Tuple[str, int]
+
+class Bucket:
+    """
+    Token bucket allowing `burst` requests every `per` seconds. A burst of 0
+    means unlimited.
+    """
+
+    def __init__(self, burst: int, per: float):
+        self.burst = burst
+        self.per = per
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.burst / self.per)
+        self.stamp = now
+
+    def wait_time(self, reserve: float = 0) -> float:
+        """
+        Seconds until a request can go out while leaving `reserve` tokens
+        """
+        if not self.burst:
+            return 0
+        self._refill()
+        missing = 1 + reserve - self.tokens
+        return max(0, missing * self.per / self.burst)
+
+    def take(self):
+        """
+        Use up a token
+        """
+        if self.burst:
+            self._refill()
+            self.tokens -= 1
+
+class _Job:
+    def __init__(self, priority: Priority, factory: typing.Callable[[], typing.Awaitable], coalesce):
+        self.priority = priority
+        self.factory = factory
+        self.coalesce = coalesce
+        self.future = asyncio.get_event_loop().create_future()
+
+class _Route:
+    def __init__(self, bucket: Bucket):
+        self.bucket = bucket
+        self.queue: typing.List[typing.Tuple[int, int, _Job]] = []
+        self.coalesce: typing.Dict[object, _Job] = {}
+        self.draining: typing.Optional[asyncio.Future] = None
+
+class Scheduler:
+    """
+    Per-route and global rate limiting with priorities
+    """
+
+    def __init__(self, *,
+                 global_rate: typing.Tuple[int, float],
+                 route_rates: typing.Dict[str, typing.Tuple[int, float]],
+                 reserve: typing.Dict[Priority, float]):
+        self.global_bucket = Bucket(*global_rate)
+        self.route_rates = route_rates
+        self.reserve = reserve
+        self._routes: typing.Dict[Route, _Route] = {}
+        self._seq = itertools.count()
+        # priority -> routes whose next job is only waiting on the global bucket
+        self._blocked: typing.Counter[Priority] = collections.Counter()
+
+    def _route(self, key: Route) -> _Route:
+        route = self._routes.get(key)
+        if route is None:
+            rate = self.route_rates.get(key[0], (0, 1))
+            route = self._routes[key] = _Route(Bucket(*rate))
+        return route
+
+    def _wait_time(self, route: _Route, priority: Priority) -> float:
+        return max(route.bucket.wait_time(), self._global_wait_time(priority))
+
+    def _global_wait_time(self, priority: Priority) -> float:
+        wait = self.global_bucket.wait_time(self.reserve.get(priority, 0))
+        if not wait and self.global_bucket.burst and any(count for ahead, count in self._blocked.items() if ahead < priority):
+            # leave the next token for them
+            wait = self.global_bucket.per / self.global_bucket.burst
+        return wait
+
+    def configure(self, *,
+                  global_rate: typing.Tuple[int, float],
+                  route_rates: typing.Dict[str, typing.Tuple[int, float]],
+                  reserve: typing.Dict[Priority, float]):
+        """
+        Change the limits, including for routes already in use
+        """
+        self.global_bucket.burst, self.global_bucket.per = global_rate
+        self.route_rates = route_rates
+        self.reserve = reserve
+        for key, route in self._routes.items():
+            route.bucket.burst, route.bucket.per = route_rates.get(key[0], (0, 1))
+
+    def spend(self):
+        """
+        Account for a request made without going through the scheduler
+        """
+        self.global_bucket.take()
+
+    def submit(
+            self,
+            key: Route,
+            priority: Priority,
+            factory: typing.Callable[[], typing.Awaitable],
+            *,
+            coalesce=None
+        ) -> asyncio.Future:
+        """
+        Run `factory()` once the route and priority allow it, returning a
+        future for its result.
+
+        If a queued job on the route has the same `coalesce` key, it's
+        replaced by this one instead, and both get this one's result.
+        Cancelling the future drops the job if it hasn't started yet.
+        """
+        route = self._route(key)
+
+        if coalesce is not None:
+            job = route.coalesce.get(coalesce)
+            if job is not None and not job.future.done():
+                job.factory = factory
+                return job.future
+
+        job = _Job(priority, factory, coalesce)
+        ahead = route.queue and route.queue[0][0] <= priority
+        if not ahead and self._wait_time(route, priority) == 0:
+            self._start(route, job)
+            return job.future
+
+        heapq.heappush(route.queue, (priority, next(self._seq), job))
+        if coalesce is not None:
+            route.coalesce[coalesce] = job
+        if route.draining is None:
+            route.draining = asyncio.ensure_future(self._drain(route))
+        return job.future
+
+    def _start(self, route: _Route, job: _Job) -> asyncio.Future:
+        route.bucket.take()
+        self.global_bucket.take()
+        return asyncio.ensure_future(self._run(job))
+
+    @staticmethod
+    async def _run(job: _Job):
+        try:
+            result = await job.factory()
+        except Exception as err: # pylint: disable=broad-except
+            if not job.future.done():
+                job.future.set_exception(err)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+
+    async def _drain(self, route: _Route):
+        """
+        Let queued jobs out in priority order as the buckets allow
+        """
+        try:
+            while route.queue:
+                priority, _, job = route.queue[0]
+                if job.future.done(): # cancelled while queued
+                    heapq.heappop(route.queue)
+                    route.coalesce.pop(job.coalesce, None)
+                    continue
+
+                delay = route.bucket.wait_time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                delay = self._global_wait_time(priority)
+                if delay > 0:
+                    self._blocked[priority] += 1
+                    try:
+                        await asyncio.sleep(delay)
+                    finally:
+                        self._blocked[priority] -= 1
+                    continue
+
+                heapq.heappop(route.queue)
+                if route.coalesce.get(job.coalesce) is job:
+                    del route.coalesce[job.coalesce]
+                # in order within the route, so e.g. edits can't overtake
+                await self._start(route, job)
+        finally:
+            route.draining = None
+
+def _rate(value) -> typing.Tuple[int, float]:
+    burst, per = value
+    return int(burst), float(per)
+
+def _limits(options) -> dict:
+    return {
+        "global_rate": _rate(options["global"]),
+        "route_rates": {kind: _rate(rate) for kind, rate in options["routes"].items()},
+        "reserve": {Priority[name.upper()]: float(value)
+                    for name, value in options["reserve"].items()},
+    }
+
+SCHEDULER = Scheduler(**_limits(config.get("outbound")))
+
+@config.on_change("outbound")
+def reconfigure(options):
+    SCHEDULER.configure(**_limits(options))
+
+def destination_route(dest: discord.abc.Messageable) -> Route:
+    """
+    The route that sending to a destination counts against
+    """
+    dest = getattr(dest, "channel", dest) # contexts
+    if isinstance(dest, discord.abc.User):
+        return ("dm", dest.id)
+    return ("messages", dest.id)
+
+def send(
+        dest: discord.abc.Messageable,
+        *args,
+        priority: Priority = Priority.INTERACTIVE,
+        **kwargs
+    ) -> asyncio.Future:
+    """
+    Schedule `dest.send(...)`
+    """
+    return SCHEDULER.submit(destination_route(dest), priority,
+                            lambda: dest.send(*args, **kwargs))
+
+def edit(
+        message: discord.Message,
+        *,
+        priority: Priority = Priority.BACKGROUND,
+        **kwargs
+    ) -> asyncio.Future:
+    """
+    Schedule `message.edit(...)`, replacing any queued edit to the same
+    message
+    """
+    return SCHEDULER.submit(("messages", message.channel.id), priority,
+                            lambda: message.edit(**kwargs),
+                            coalesce=("edit", message.id))
+
+def react(
+        message: discord.Message,
+        emoji,
+        *,
+        priority: Priority = Priority.INTERACTIVE
+    ) -> asyncio.Future:
+    """
+    Schedule `message.add_reaction(emoji)`
+    """
+    return SCHEDULER.submit(("reactions", message.channel.id), priority,
+                            lambda: message.add_reaction(emoji))
+
+def call(
+        key: Route,
+        func: typing.Callable[[], typing.Awaitable],
+        *,
+        priority: Priority = Priority.BACKGROUND
+    ) -> asyncio.Future:
+    """
+    Schedule some other request
+    """
+    return SCHEDULER.submit(key, priority, func)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Record raw gateway dispatch events to disk, for replaying offline later (see
+bench.replay).
+
+Recordings are gzipped JSON lines, one event per line:
+
+    {"ts": <unix time>, "t": "MESSAGE_REACTION_ADD", "d": {...}}
+
+Files are rotated once they reach a certain (uncompressed) size, and only the
+most recent few are kept.
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import secrets
+import time
+import typing
+
+_L = logging.getLogger(__name__)
+
+# Lower bits of a snowflake, which aren't part of the timestamp
+_SNOWFLAKE_LOW = (1 << 22) - 1
+
+class Anonymizer:
+    """
+    Consistently replace snowflake IDs with fake ones.
+
+    The timestamp part of each snowflake is kept, so anything that depends on
+    the age of an object still behaves the same. The rest is replaced with a
+    salted hash, so IDs can't be correlated across recording sessions.
+    """
+
+    def __init__(self, salt: typing.Optional[bytes] = None):
+        self.salt = salt or secrets.token_bytes(16)
+
+    def snowflake(self, value: str) -> str:
+        """
+        Anonymize a single snowflake, given as a string as in gateway payloads
+        """
+        try:
+            ident = int(value)
+        except (TypeError, ValueError):
+            return value
+        digest = hashlib.blake2b(value.encode(), digest_size=8, key=self.salt).digest()
+        low = int.from_bytes(digest, "big") & _SNOWFLAKE_LOW
+        return str((ident & ~_SNOWFLAKE_LOW) | low)
+
+    def __call__(self, data):
+        """
+        Anonymize all IDs in a payload
+        """
+        if isinstance(data, dict):
+            out = {}
+            for key, value in data.items():
+                if isinstance(value, str) and (key == "id" or key.endswith("_id")):
+                    out[key] = self.snowflake(value)
+                elif isinstance(value, list) and (key == "roles" or key.endswith("_ids")):
+                    out[key] = [self.snowflake(v) if isinstance(v, str) else self(v)
+                                for v in value]
+                else:
+                    out[key] = self(value)
+            return out
+        if isinstance(data, list):
+            return [self(v) for v in data]
+        return data
+
+class Recorder:
+    """
+    Writes dispatch events to a rotating set of compressed logs
+    """
+
+    def __init__(self, path: str, *,
+                 anonymize: bool = False,
+                 rotate_bytes: int = 64 << 20,
+                 keep: int = 10,
+                 events: typing.Optional[typing.Collection[str]] = None):
+        self.directory = pathlib.Path(path)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.anonymize = Anonymizer() if anonymize else None
+        self.rotate_bytes = rotate_bytes
+        self.keep = keep
+        self.events = set(events) if events else None
+
+        self._file = None
+        self._written = 0
+        self.recorded = 0
+
+    def _rotate(self):
+        """
+        Close the current file and start a new one, removing old ones
+        """
+        self.close()
+
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+        path = self.directory / f"gateway-{stamp}.jsonl.gz"
+        _L.info("recording gateway events to %s", path)
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._written = 0
+
+        old = sorted(self.directory.glob("gateway-*.jsonl.gz"))
+        for stale in old[:-self.keep]:
+            _L.info("removing old recording %s", stale)
+            os.remove(stale)
+
+    def record(self, msg: dict):
+        """
+        Record one decoded gateway message, if it's a dispatch we care about
+        """
+        if msg.get("op") != 0:
+            return
+        event = msg.get("t")
+        if self.events is not None and event not in self.events:
+            return
+
+        data = msg.get("d")
+        if self.anonymize is not None:
+            data = self.anonymize(data)
+
+        if self._file is None or self._written >= self.rotate_bytes:
+            self._rotate()
+
+        line = json.dumps({"ts": time.time(), "t": event, "d": data},
+                          separators=(",", ":")) + "\n"
+        self._file.write(line)
+        self._written += len(line)
+        self.recorded += 1
+
+    async def on_socket_response(self, msg):
+        """
+        Listener for discord.py's socket_response event
+        """
+        try:
+            self.record(msg)
+        except Exception: # pylint: disable=broad-except
+            # Recording should never get in the way of the bot itself
+            _L.exception("failed to record gateway event")
+
+    def close(self):
+        """
+        Finish the current file
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def attach(bot, options: dict) -> Recorder:
+    """
+    Start recording all gateway events the bot receives
+    """
+    recorder = Recorder(
+        options["path"],
+        anonymize=options.get("anonymize", False),
+        rotate_bytes=int(options.get("rotate_mb", 64)) << 20,
+        keep=options.get("keep", 10),
+        events=options.get("events"))
+    bot.add_listener(recorder.on_socket_response, "on_socket_response")
+    return recorder
+
+def read(path: typing.Union[str, pathlib.Path]) -> typing.Iterator[dict]:
+    """
+    Read back a recording, in order
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as recording:
+        for line in recording:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
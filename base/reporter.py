@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Report exceptions to the bot owner without flooding them (or Discord).
+
+Exceptions are fingerprinted by their type and the frames they passed
+through, so the same failure happening over and over is reported once with a
+count. Reports are sent as a digest after a short window, and only a bounded
+number of distinct failures are kept per digest; anything past that is
+counted and mentioned rather than sent.
+"""
+
+import asyncio
+import collections
+import datetime
+import hashlib
+import logging
+import traceback
+import typing
+
+import discord
+from discord.ext import commands
+
+from . import outbound
+
+_L = logging.getLogger(__name__)
+
+# Discord's message length limit, less room for the header and code fences
+_MAX_TRACEBACK = 1800
+
+ExcInfo = typing.Tuple[type, BaseException, typing.Any]
+
+def fingerprint(exc_info: ExcInfo) -> str:
+    """
+    Identify an exception by its type and where it was raised from, ignoring
+    the message (which often includes IDs)
+    """
+    exc_type, _, exc_tb = exc_info
+    frames = traceback.extract_tb(exc_tb)
+    key = "\n".join([f"{exc_type.__module__}.{exc_type.__qualname__}"]
+                    + [f"{frame.filename}:{frame.name}:{frame.lineno}" for frame in frames])
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+class Failure:
+    """
+    One distinct failure waiting to be reported
+    """
+
+    def __init__(self, where: str, text: str):
+        self.where = where
+        self.text = text
+        self.count = 0
+        self.first = datetime.datetime.now()
+        self.last = self.first
+
+class Reporter:
+    """
+    Collects exceptions and DMs the owner a digest of them
+    """
+
+    def __init__(self, bot: commands.Bot, *,
+                 window: float = 60,
+                 max_pending: int = 10,
+                 delete_after: typing.Optional[float] = None):
+        self.bot = bot
+        self.window = window
+        self.max_pending = max_pending
+        self.delete_after = delete_after
+
+        self._owner: typing.Optional[discord.User] = None
+        self._owner_lookup: typing.Optional[asyncio.Future] = None
+        self._pending: typing.Dict[str, Failure] = collections.OrderedDict()
+        self._dropped = 0
+        self._flush: typing.Optional[asyncio.Future] = None
+
+    async def owner(self) -> discord.User:
+        """
+        The bot's owner, looked up once
+        """
+        if self._owner is None:
+            if self._owner_lookup is None:
+                self._owner_lookup = asyncio.ensure_future(self.bot.application_info())
+            try:
+                self._owner = (await asyncio.shield(self._owner_lookup)).owner
+            except Exception:
+                self._owner_lookup = None # try again next time
+                raise
+        return self._owner
+
+    def report(self, where: str, exc_info: ExcInfo):
+        """
+        Queue an exception to be sent in the next digest
+        """
+        key = fingerprint(exc_info)
+        failure = self._pending.get(key)
+        if failure is None:
+            if len(self._pending) >= self.max_pending:
+                self._dropped += 1
+                return
+            text = "".join(traceback.format_exception(*exc_info))
+            failure = self._pending[key] = Failure(where, text)
+
+        failure.count += 1
+        failure.last = datetime.datetime.now()
+
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._send_later())
+
+    async def _send_later(self):
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, collections.OrderedDict()
+        dropped, self._dropped = self._dropped, 0
+        self._flush = None
+
+        try:
+            owner = await self.owner()
+            for failure in pending.values():
+                text = failure.text
+                if len(text) > _MAX_TRACEBACK:
+                    text = "…" + text[-_MAX_TRACEBACK:]
+                times = (f"{failure.first:%H:%M:%S}" if failure.count == 1
+                         else f"×{failure.count}, {failure.first:%H:%M:%S}–{failure.last:%H:%M:%S}")
+                await outbound.send(
+                    owner, f"\u200bISE! {failure.where} ({times})\n```\n{text}```",
+                    delete_after=self.delete_after, priority=outbound.Priority.BACKGROUND)
+            if dropped:
+                await outbound.send(
+                    owner, f"\u200b{dropped} more errors not reported (see logs)",
+                    delete_after=self.delete_after, priority=outbound.Priority.BACKGROUND)
+        except Exception: # pylint: disable=broad-except
+            # Nothing left to tell about this but the logs
+            _L.exception("failed to send error digest")
@@ -13,12 +13,32 @@ _L = logging.getLogger(__name__)
 
 _SETTINGS = dict()
 
+# Called with (option, server, channel, user) whenever a stored value changes,
+# keyed by qualified name so a module that's reloaded replaces its own
+_WATCHERS: typing.Dict[str, typing.Callable[[str, int, int, int], None]] = {}
+
 class ArgError(Exception):
     pass
 
-TargetType = typing.Union[commands.Context, discord.Message]
+TargetType = typing.Union[commands.Context, discord.Message, discord.abc.GuildChannel]
 ContextType = typing.List[typing.Union[str, typing.Tuple[str, str]]]
 
+class _InChannel:
+    """
+    Stands in for a message, to look up settings with only a channel
+    """
+
+    def __init__(self, channel: discord.abc.GuildChannel):
+        self.channel = channel
+        self.guild = channel.guild
+
+def _as_message(target: TargetType):
+    if isinstance(target, commands.Context):
+        return target.message
+    if not hasattr(target, "channel"): # a channel itself
+        return _InChannel(target)
+    return target
+
 class SettingBase(abc.ABC):
     """
     A base class for settings
@@ -52,9 +72,7 @@ class SettingBase(abc.ABC):
         """
         Retrieve the value for a given target context
         """
-        if isinstance(target, commands.Context):
-            target = target.message
-        shown = await self.impl_show(target)
+        shown = await self.impl_show(_as_message(target))
         return shown if shown is not None else str(self.default)
 
     @abc.abstractmethod
@@ -71,9 +89,7 @@ class SettingBase(abc.ABC):
         """
         Retrieve the value for a given target context
         """
-        if isinstance(target, commands.Context):
-            target = target.message
-        value = await self.impl_get(target)
+        value = await self.impl_get(_as_message(target))
         return value if value is not None else self.default
 
     @abc.abstractmethod
@@ -139,6 +155,21 @@ def true_false(string: str) -> bool:
         return False
     raise ValueError("Neither true nor false")
 
+def watch(func: typing.Callable[[str, int, int, int], None]):
+    """
+    Register a function to be called with (option, server, channel, user)
+    whenever a stored setting is changed or deleted. Usable as a decorator.
+    """
+    _WATCHERS[f"{func.__module__}.{func.__qualname__}"] = func
+    return func
+
+def _changed(option: str, server: int, channel: int, user: int):
+    for func in list(_WATCHERS.values()):
+        try:
+            func(option, server, channel, user)
+        except Exception: # pylint: disable=broad-except
+            _L.exception("settings watcher %r failed", func)
+
 sql.require_table("settings", """
         server INTEGER NOT NULL,
         channel INTEGER NOT NULL,
@@ -148,7 +179,7 @@ sql.require_table("settings", """
         PRIMARY KEY(server, channel, user, option)
         """)
 
-def get_stored(
+async def get_stored(
         option: str,
         default: object = None,
         *,
@@ -159,7 +190,7 @@ def get_stored(
     """
     Get a value from the SQL table
     """
-    results = sql.query(f"""
+    results = await sql.read("""
         SELECT value FROM settings
         WHERE server=? AND channel=? AND user=? AND option=?
         """, server, channel, user, option)
@@ -175,10 +206,11 @@ def delete_stored(
     """
     Delete a value in the settings table
     """
-    return sql.query(f"""
+    sql.query(f"""
         DELETE FROM settings
         WHERE server=? AND channel=? AND user=? AND option=?
         """, server, channel, user, option)
+    _changed(option, server, channel, user)
 
 def set_stored(
         option: str,
@@ -200,6 +232,7 @@ def set_stored(
             server, channel, user, option, value
         ) VALUES (?, ?, ?, ?, ?)
         """, server, channel, user, option, value)
+    _changed(option, server, channel, user)
 
 class ServerSetting(SettingBase):
     """
@@ -219,11 +252,11 @@ class ServerSetting(SettingBase):
         self.deser = deser
 
     async def impl_show(self, target: discord.Message) -> str:
-        value = get_stored(self.name, server=target.channel.guild.id)
+        value = await get_stored(self.name, server=target.channel.guild.id)
         return str(self.deser(value)) if value is not None else None
 
     async def impl_get(self, target: discord.Message) -> object:
-        value = get_stored(self.name, server=target.channel.guild.id)
+        value = await get_stored(self.name, server=target.channel.guild.id)
         return self.deser(value) if value is not None else None
 
     async def impl_set(
@@ -255,7 +288,7 @@ class ServerChannelSetting(SettingBase):
     async def impl_show(self, target: discord.Message) -> str:
         shown = ""
         serverwide = False
-        results = sql.query("""
+        results = await sql.read("""
             SELECT channel, value FROM settings
             WHERE server=? AND option=?
             ORDER BY channel ASC
@@ -281,9 +314,9 @@ class ServerChannelSetting(SettingBase):
 
     async def impl_get(self, target: discord.Message) -> object:
         chan = target.channel
-        value = get_stored(self.name, server=chan.guild.id, channel=chan.id)
+        value = await get_stored(self.name, server=chan.guild.id, channel=chan.id)
         if value is None:
-            value = get_stored(self.name, server=chan.guild.id)
+            value = await get_stored(self.name, server=chan.guild.id)
         return self.deser(value) if value is not None else None
 
     async def impl_set(
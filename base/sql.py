@@ -1,41 +1,317 @@
 #!/usr/bin/env python3
 
+"""
+Database access.
+
+Where the database lives is up to a backend, chosen with `sql.engine` in the
+config: a file, or memory (for tests and benchmarks, optionally starting from
+and saved back to a file). It's opened by the first query, or explicitly with
+`init`, which can also be given a backend to use instead.
+
+There is a single writer connection, used by `query` and `transact`. Reads
+which don't need to see uncommitted writes can instead use `read`, which for
+files runs on a small pool of read-only connections in worker threads. With
+the database in WAL mode, these don't wait for the writer.
+
+Tables (and anything else set up at import) are registered with
+`require_table` and `on_open`, and set up again whenever a database is opened.
+"""
+
 from contextlib import asynccontextmanager
+import abc
+import asyncio
+import concurrent.futures
 import logging
+import pathlib
 import sqlite3
+import threading
+import time
+import typing
 
 from . import config
-from .arlock import ARLock
+from .arlock import RWLock
 
 _L = logging.getLogger(__name__)
 
-def _connect() -> sqlite3.Connection:
+ProgressCallback = typing.Callable[[int, int], None]
+
+def _copy(
+        src: sqlite3.Connection,
+        target: str,
+        pages: int,
+        pause: float,
+        progress: typing.Optional[ProgressCallback]
+    ):
+    dst = sqlite3.connect(target)
+    def step(_status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+        if pause:
+            time.sleep(pause)
+    try:
+        src.backup(dst, pages=pages, progress=step)
+    finally:
+        dst.close()
+
+AUTO_VACUUM = {"none": 0, "full": 1, "incremental": 2}
+
+class Backend(abc.ABC):
+    """
+    Where the database lives.
+
+    `writer` is the one connection used for writes, and reads which need to
+    see them. Backends with `readers` can make read-only connections with
+    `reader()` for use in other threads; otherwise reads use the writer too.
+
+    Given an `auto_vacuum` mode, an existing database in another mode is
+    rebuilt in it when it's opened, before anything else can use it.
+    """
+
+    readers = False
+
+    def __init__(self, writer: sqlite3.Connection, auto_vacuum: typing.Optional[str] = None):
+        writer.row_factory = sqlite3.Row
+        self.writer = writer
+        if auto_vacuum is not None and \
+                writer.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM[auto_vacuum]:
+            _L.info("rebuilding database for auto_vacuum=%s", auto_vacuum)
+            self.vacuum(auto_vacuum)
+
+    @abc.abstractmethod
+    def reader(self) -> sqlite3.Connection:
+        """
+        A new read-only connection, for a worker thread. Only used if
+        `readers` is set.
+        """
+
+    @abc.abstractmethod
+    def backup(self, target: str, *, pages: int, pause: float,
+               progress: typing.Optional[ProgressCallback]):
+        """
+        Copy the database to `target`; see `sql.backup`
+        """
+
+    @abc.abstractmethod
+    def vacuum(self, auto_vacuum: str):
+        """
+        Rebuild the database with an auto_vacuum mode. This blocks other
+        writers until it's done.
+        """
+
+    @abc.abstractmethod
+    def incremental_vacuum(self, pages: int):
+        """
+        Give up to `pages` free pages back to the filesystem, through the
+        writer. This blocks the event loop, so keep `pages` small.
+        """
+
+    def close(self):
+        self.writer.close()
+
+class FileBackend(Backend):
+    """
+    A database file, read from other threads without waiting for the writer
+    """
+
+    readers = True
+
+    def __init__(self, path: str, *, journal_mode: str, synchronous: str, auto_vacuum: str):
+        self.path = path
+        con = sqlite3.connect(path, isolation_level=None)
+        # Only takes effect on a new database; existing ones are rebuilt
+        con.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+        mode = con.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()[0]
+        con.execute(f"PRAGMA synchronous={synchronous}")
+        _L.info("opened database %s, journal_mode=%s", path, mode)
+        super().__init__(con, auto_vacuum)
+
+    def reader(self) -> sqlite3.Connection:
+        uri = pathlib.Path(self.path).resolve().as_uri() + "?mode=ro"
+        con = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def backup(self, target, *, pages, pause, progress):
+        # Inside one read transaction, so it's a consistent snapshot from
+        # when it started. With WAL, writes carry on meanwhile, and they don't
+        # make the copy start over.
+        src = self.reader()
+        try:
+            src.execute("begin")
+            src.execute("SELECT COUNT(*) FROM sqlite_master").fetchall() # start reading now
+            _copy(src, target, pages, pause, progress)
+        finally:
+            src.close()
+
+    def vacuum(self, auto_vacuum):
+        con = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            con.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+            con.execute("VACUUM")
+        finally:
+            con.close()
+
+    def incremental_vacuum(self, pages):
+        # On the writer, so writes from the event loop never find the
+        # database locked by it. execute() only runs one step of this,
+        # freeing a single page.
+        self.writer.executescript(f"PRAGMA incremental_vacuum({pages});")
+
+class MemoryBackend(Backend):
+    """
+    A database in memory, which starts as a copy of `snapshot` if that
+    exists, and is saved back there when closed. Everything goes through the
+    writer.
+    """
+
+    def __init__(self, snapshot: typing.Optional[str] = None, *, auto_vacuum: str = "none"):
+        self.snapshot = snapshot
+        # Backups use it from worker threads; sqlite serializes
+        con = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+        con.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+        if snapshot is not None and pathlib.Path(snapshot).exists():
+            src = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+            try:
+                src.backup(con)
+            finally:
+                src.close()
+            _L.info("opened in-memory database from %s", snapshot)
+        super().__init__(con, auto_vacuum)
+
+    def reader(self):
+        raise NotImplementedError("in-memory databases are only read through the writer")
+
+    def backup(self, target, *, pages, pause, progress):
+        # Writes through the source connection are copied as they happen,
+        # so this doesn't start over either
+        _copy(self.writer, target, pages, pause, progress)
+
+    def vacuum(self, auto_vacuum):
+        self.writer.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+        self.writer.execute("VACUUM")
+
+    def incremental_vacuum(self, pages):
+        self.writer.executescript(f"PRAGMA incremental_vacuum({pages});")
+
+    def close(self):
+        if self.snapshot is not None:
+            _copy(self.writer, self.snapshot, -1, 0, None)
+            _L.info("saved in-memory database to %s", self.snapshot)
+        super().close()
+
+def configured() -> Backend:
+    """
+    The backend set up in the config
+    """
+    engine = config.get("sql.engine")
+    if engine == "file":
+        return FileBackend(config.get("sql.path"),
+                           journal_mode=config.get("sql.journal_mode"),
+                           synchronous=config.get("sql.synchronous"),
+                           auto_vacuum=config.get("sql.auto_vacuum"))
+    if engine == "memory":
+        return MemoryBackend(config.get("sql.snapshot"), auto_vacuum=config.get("sql.auto_vacuum"))
+    raise ValueError(f"unknown sql.engine {engine!r}")
+
+DB_LOCK = RWLock()
+
+_BACKEND: typing.Optional[Backend] = None
+# Keyed by where they came from, so a module that's reloaded replaces its own
+_ON_OPEN: typing.Dict[str, typing.Callable[[], None]] = {}
+
+_READERS = None
+_READER_LOCAL = threading.local()
+_READ_TXN_CONNECTIONS = []
+
+def init(backend: typing.Optional[Backend] = None):
     """
-    Create a database connection
+    Open the database, closing any that's already open, and set up what's
+    been registered with `on_open`. Uses the configured backend by default.
     """
-    con = sqlite3.connect(config.get("sql.path"), isolation_level=None)
-    con.row_factory = sqlite3.Row
-    return con
+    global _BACKEND # pylint: disable=global-statement
+    if _BACKEND is not None:
+        close()
+    _BACKEND = backend or configured()
+    for func in list(_ON_OPEN.values()):
+        func()
 
-DATABASE = _connect()
-DB_LOCK = ARLock()
+def close():
+    """
+    Close the database, if it's open
+    """
+    global _BACKEND, _READERS # pylint: disable=global-statement
+    if _BACKEND is None:
+        return
+    if _READERS is not None:
+        _READERS.shutdown(wait=True)
+        _READERS = None
+    while _READ_TXN_CONNECTIONS:
+        _READ_TXN_CONNECTIONS.pop().close()
+    _BACKEND.close()
+    _BACKEND = None
+
+def backend() -> Backend:
+    """
+    The open backend, opening the database if it isn't yet
+    """
+    if _BACKEND is None:
+        init()
+    return _BACKEND
+
+def database() -> sqlite3.Connection:
+    """
+    The writer connection, opening the database if it isn't yet
+    """
+    return backend().writer
+
+def on_open(func: typing.Callable[[], None], *, name: typing.Optional[str] = None):
+    """
+    Decorator - set up something in the database (e.g. indexes), now if it's
+    open, and again whenever a database is opened. Registering again under
+    the same `name` (by default, the function's qualified name) replaces it.
+    """
+    _ON_OPEN[name or f"{func.__module__}.{func.__qualname__}"] = func
+    if _BACKEND is not None:
+        func()
+    return func
 
 @asynccontextmanager
-async def transact():
+async def transact(mode: str = "write"):
     """
-    Async transaction which locks the database
+    Async transaction which locks the database.
+
+    Write transactions (the default) are exclusive, and run on the writer
+    connection. Read transactions can run alongside each other, and get a
+    consistent snapshot on a read-only connection (or are exclusive too, if
+    the backend has no readers). Reading inside a write
+    transaction uses the writer, so it sees the writes made so far.
     """
-    async with DB_LOCK:
+    if mode not in ("read", "write"):
+        raise ValueError(f"unknown transaction mode {mode!r}")
+
+    if mode == "read" and DB_LOCK.held() != "write" and backend().readers:
+        async with DB_LOCK.read():
+            con = _READ_TXN_CONNECTIONS.pop() if _READ_TXN_CONNECTIONS else backend().reader()
+            con.execute("begin")
+            try:
+                yield con
+            finally:
+                con.execute("rollback")
+                _READ_TXN_CONNECTIONS.append(con)
+        return
+
+    async with DB_LOCK.write():
+        con = database()
         _L.debug("entering savepoint")
-        DATABASE.execute("savepoint auto")
+        con.execute("savepoint auto")
         try:
-            yield DATABASE
+            yield con
         except:
-            DATABASE.execute("rollback to auto")
+            con.execute("rollback to auto")
             _L.debug("rolling back savepoint")
             raise
         finally:
-            DATABASE.execute("release auto")
+            con.execute("release auto")
             _L.debug("exiting savepoint")
 
 def esc(ident: str) -> str:
@@ -50,15 +326,72 @@ def esc(ident: str) -> str:
 
 def require_table(name, schema):
     """
-    Create a table with a certain name if it does not yet exist
+    Create a table with a certain name if it does not yet exist, whenever
+    a database is opened
     """
-    # TODO maybe check duplicates
-    DATABASE.execute(f"create table if not exists {name} ({schema})")
-    _L.info("creating table %s", name)
+    def create():
+        database().execute(f"create table if not exists {name} ({schema})")
+        _L.info("creating table %s", name)
+    on_open(create, name=f"table {name}")
 
 def query(statement, *args, **kwargs):
     """
     Return all matches to given query
     """
     _L.debug("query `%s` with args %s", statement, args or kwargs)
-    return DATABASE.execute(statement, tuple(args) or kwargs).fetchall()
+    return database().execute(statement, tuple(args) or kwargs).fetchall()
+
+def _read_in_thread(opened: Backend, statement, params):
+    """
+    Run a query on this worker thread's read-only connection
+    """
+    con = getattr(_READER_LOCAL, "con", None)
+    if con is None or _READER_LOCAL.backend is not opened:
+        con = _READER_LOCAL.con = opened.reader()
+        _READER_LOCAL.backend = opened
+    return con.execute(statement, params).fetchall()
+
+async def read(statement, *args, **kwargs):
+    """
+    Return all matches to a read-only query, without blocking on the writer.
+
+    This only sees committed data, so use `query` inside a transaction.
+    Backends without read-only connections run it on the writer instead.
+    """
+    global _READERS # pylint: disable=global-statement
+    opened = backend()
+    if not opened.readers:
+        return query(statement, *args, **kwargs)
+    if _READERS is None:
+        _READERS = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get("sql.readers"),
+            thread_name_prefix="sql-read")
+
+    _L.debug("read `%s` with args %s", statement, args or kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _READERS, _read_in_thread, opened, statement, tuple(args) or kwargs)
+
+def backup(
+        target: str,
+        *,
+        pages: int = 256,
+        pause: float = 0,
+        progress: typing.Optional[ProgressCallback] = None
+    ):
+    """
+    Copy the database to `target`, `pages` at a time with a pause after each
+    step. This blocks, so run it in a worker thread.
+
+    The copy is a consistent snapshot, and writes carry on meanwhile.
+    `progress` is called after each step with the pages copied so far and
+    the total.
+    """
+    backend().backup(target, pages=pages, pause=pause, progress=progress)
+
+def is_readonly(statement: str) -> bool:
+    """
+    Whether a statement only reads, and so can be sent to `read`
+    """
+    head = statement.lstrip().split(None, 1)
+    return bool(head) and head[0].lower() in ("select", "explain", "values")
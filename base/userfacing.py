@@ -80,3 +80,6 @@ def setup(bot):
 
     frag.setup(bot)
     resolver.setup(bot)
+
+def teardown(bot):
+    frag.teardown(bot)
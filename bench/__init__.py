@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmarks for the bot's fragments.
+
+These run the real fragment code against an in-memory fake of Discord (see
+`bench.fake`) and a scratch database, so they need no network access or bot
+token. Run them with `python -m bench`, or replay a gateway recording with
+`python -m bench.replay`.
+"""
+
+import contextlib
+import os
+import pathlib
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import yaml
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+
+def bootstrap(scratch: pathlib.Path, database: str = None, engine: str = "file"):
+    """
+    Make a working directory with a config that points at a scratch database,
+    optionally starting as a copy of an existing one. `engine` picks the
+    database backend (see base.sql).
+
+    base.config reads config.yaml and secrets.yaml from the working directory,
+    so this has to happen before anything from base is imported.
+    """
+    with open(REPO / "config.yaml") as config_file:
+        config = yaml.safe_load(config_file)
+    config["sql"]["engine"] = engine
+    config["sql"]["path"] = str(scratch / "bench.db")
+    # An in-memory database starts from (a copy of) the same file
+    config["sql"]["snapshot"] = config["sql"]["path"] if engine == "memory" else None
+    # The fake has no rate limits, so don't make up our own
+    config["outbound"]["global"] = [0, 1]
+    config["outbound"]["routes"] = {}
+    # Backups are only taken by the workloads
+    config["backup"]["interval_hours"] = 0
+
+    with open(scratch / "config.yaml", "w") as config_file:
+        yaml.safe_dump(config, config_file)
+    with open(scratch / "secrets.yaml", "w") as secrets_file:
+        yaml.safe_dump({"discord-token": None}, secrets_file)
+
+    if database is not None:
+        src = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+        dst = sqlite3.connect(config["sql"]["path"])
+        with dst:
+            src.backup(dst)
+        src.close()
+        dst.close()
+
+    os.chdir(scratch)
+    sys.path.insert(0, str(REPO))
+
+@contextlib.contextmanager
+def scratch_dir(database: str = None, engine: str = "file"):
+    """
+    Bootstrap into a temporary directory, cleaning it up afterwards
+    """
+    scratch = pathlib.Path(tempfile.mkdtemp(prefix="bench-"))
+    try:
+        bootstrap(scratch, database, engine)
+        yield scratch
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(scratch, ignore_errors=True)
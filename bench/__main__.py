@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+Run the offline benchmarks.
+
+    python -m bench                 # run everything, compare against baseline
+    python -m bench --save          # ... and overwrite the baseline
+    python -m bench -k karma        # only workloads with "karma" in the name
+    python -m bench --engine memory # with an in-memory database
+
+The baseline lives in bench/baseline.json, and is committed so that changes in
+performance show up in review.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import pathlib
+import random
+import sys
+
+from bench import REPO, scratch_dir
+
+BASELINE = pathlib.Path(__file__).resolve().parent / "baseline.json"
+
+_L = logging.getLogger("bench")
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Find metrics that got worse by more than `tolerance` (a fraction)
+    """
+    regressions = []
+    for name, now in results.items():
+        then = baseline.get(name)
+        if then is None:
+            continue
+        if now["events_per_sec"] < then["events_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: events/sec {then['events_per_sec']:.1f} -> {now['events_per_sec']:.1f}")
+        if now["p99_ms"] > then["p99_ms"] * (1 + tolerance) + 1:
+            regressions.append(f"{name}: p99 {then['p99_ms']:.1f}ms -> {now['p99_ms']:.1f}ms")
+        if now["rest_per_event"] > then["rest_per_event"] + 0.01:
+            regressions.append(f"{name}: REST/event {then['rest_per_event']:.2f} -> {now['rest_per_event']:.2f}")
+    return regressions
+
+def report(results: dict, baseline: dict):
+    """
+    Print a table of results, with baseline events/sec for comparison
+    """
+    print(f"{'workload':<24} {'events':>7} {'ev/s':>9} {'base ev/s':>9} "
+          f"{'p50ms':>7} {'p90ms':>7} {'p99ms':>7} {'REST/ev':>8}")
+    for name, res in results.items():
+        base = baseline.get(name, {}).get("events_per_sec")
+        base = f"{base:9.1f}" if base is not None else f"{'-':>9}"
+        print(f"{name:<24} {res['events']:>7} {res['events_per_sec']:>9.1f} {base} "
+              f"{res['p50_ms']:>7.2f} {res['p90_ms']:>7.2f} {res['p99_ms']:>7.2f} "
+              f"{res['rest_per_event']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="select", default="",
+                        help="only run workloads containing this string")
+    parser.add_argument("--scale", type=int, default=500,
+                        help="events per workload (default %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="fake REST latency in seconds (default %(default)s)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="extra random REST latency in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=("file", "memory"), default="file",
+                        help="database backend (default %(default)s)")
+    parser.add_argument("--save", action="store_true",
+                        help="overwrite the baseline with these results")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fractional slowdown before flagging (default %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    baseline = {}
+    if BASELINE.exists():
+        baseline = json.loads(BASELINE.read_text())
+
+    with scratch_dir(engine=args.engine):
+        # pylint: disable=import-outside-toplevel
+        from bench.harness import Env
+        from bench.workloads import WORKLOADS
+
+        async def run():
+            env = Env(latency=args.latency, jitter=args.jitter)
+            results = {}
+            for name, func in WORKLOADS.items():
+                if args.select not in name:
+                    continue
+                _L.info("running %s", name)
+                measure = await func(env, args.scale)
+                await env.bot.drain()
+                results[name] = measure.summary()
+            return results
+
+        results = asyncio.get_event_loop().run_until_complete(run())
+
+    report(results, baseline)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print("REGRESSION", line)
+
+    if args.save:
+        baseline.update({name: {key: round(value, 3) for key, value in res.items()}
+                         for name, res in results.items()})
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print(f"saved baseline to {BASELINE.relative_to(REPO)}")
+
+    return 1 if regressions and not args.save else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+
+"""
+An in-memory stand-in for the parts of Discord that the fragments touch.
+
+Anything that would be a REST call in discord.py goes through
+`FakeDiscord.rest`, which counts the call by route and sleeps for the
+configured latency. Cache lookups (get_user, get_channel, ...) are free, like
+they are with a real gateway connection.
+"""
+
+import asyncio
+import collections
+import datetime
+import importlib
+import itertools
+import random
+import sys
+import types
+
+import discord
+from discord.ext import commands
+
+DISCORD_EPOCH = 1420070400000
+
+_MISSING = object()
+
+def make_snowflake(when: datetime.datetime = None, seq: int = 0) -> int:
+    """
+    Make a snowflake ID for a given (naive UTC) time
+    """
+    if when is None:
+        when = datetime.datetime.utcnow()
+    epoch = datetime.datetime(1970, 1, 1)
+    millis = int((when - epoch).total_seconds() * 1000)
+    return ((millis - DISCORD_EPOCH) << 22) | (seq & 0x3fffff)
+
+class FakeDiscord:
+    """
+    Shared state for the fake: all objects, plus REST accounting.
+    """
+
+    def __init__(self, *, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = collections.Counter()
+        self._seq = itertools.count(1)
+
+        self.users = {}
+        self.channels = {}
+        self.guilds = {}
+
+    def snowflake(self) -> int:
+        """
+        Generate a new, unique, current ID
+        """
+        return make_snowflake(seq=next(self._seq))
+
+    async def rest(self, route: str):
+        """
+        Account for a single REST call
+        """
+        self.calls[route] += 1
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+
+    def rest_total(self) -> int:
+        """
+        Total REST calls made so far
+        """
+        return sum(self.calls.values())
+
+    def not_found(self, what: str):
+        """
+        Construct the exception discord.py would raise for a 404
+        """
+        resp = _FakeResponse(404, "Not Found")
+        return discord.NotFound(resp, {"code": 10000, "message": f"Unknown {what}"})
+
+    def user(self, name: str, *, bot: bool = False, uid: int = None) -> discord.User:
+        """
+        Create a user
+        """
+        uid = uid or self.snowflake()
+        user = discord.User(state=None, data={
+            "id": uid,
+            "username": name,
+            "discriminator": f"{uid % 10000:04}",
+            "avatar": None,
+            "bot": bot,
+            })
+        self.users[uid] = user
+        return user
+
+    def guild(self, name: str, me: discord.User, *, gid: int = None) -> "FakeGuild":
+        """
+        Create a guild, with the bot as a member
+        """
+        guild = FakeGuild(self, gid or self.snowflake(), name)
+        guild.me = guild.add_member(me)
+        self.guilds[guild.id] = guild
+        return guild
+
+class _FakeResponse:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+class FakeMember(discord.Member):
+    """
+    A member which wraps a user, without any connection state
+    """
+    # pylint: disable=super-init-not-called
+
+    def __init__(self, user: discord.User, guild: "FakeGuild"):
+        self._user = user
+        self._state = None
+        self._roles = discord.utils.SnowflakeList([])
+        self._client_status = {None: "offline"}
+        self.guild = guild
+        self.joined_at = None
+        self.premium_since = None
+        self.activities = ()
+        self.nick = None
+
+class FakeRole:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, rid: int, name: str):
+        self.id = rid
+        self.name = name
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __eq__(self, other):
+        return getattr(other, "id", None) == self.id
+
+class FakeReaction:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, message: "FakeMessage", emoji: str):
+        self.message = message
+        self.emoji = emoji
+        self.user_ids = set()
+
+    @property
+    def count(self):
+        return len(self.user_ids)
+
+    @property
+    def me(self):
+        return self.message.channel.guild.me.id in self.user_ids
+
+    async def users(self, *, limit=None, after=None):
+        """
+        Page through who reacted, one REST call per 100 users
+        """
+        ids = sorted(self.user_ids)
+        if after is not None:
+            ids = [i for i in ids if i > after.id]
+        if limit is not None:
+            ids = ids[:limit]
+        for idx, uid in enumerate(ids):
+            if idx % 100 == 0:
+                await self.message._fake.rest("get_reaction_users")
+            yield self.message._fake.users[uid]
+
+class FakeMessage:
+    """
+    A message, with reactions
+    """
+
+    def __init__(self, fake, channel, author, content, *, mid=None):
+        self._fake = fake
+        self.id = mid or fake.snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.attachments = []
+        self.embeds = []
+        self._reactions = {}
+        self.created_at = discord.utils.snowflake_time(self.id)
+
+    @property
+    def reactions(self):
+        return [r for r in self._reactions.values() if r.user_ids]
+
+    @property
+    def jump_url(self):
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+    def react(self, emoji: str, user_id: int):
+        """
+        Record a reaction as though it came in from the gateway
+        """
+        self._reactions.setdefault(emoji, FakeReaction(self, emoji)).user_ids.add(user_id)
+
+    def unreact(self, emoji: str, user_id: int):
+        """
+        Record a reaction removal as though it came in from the gateway
+        """
+        if emoji in self._reactions:
+            self._reactions[emoji].user_ids.discard(user_id)
+
+    async def add_reaction(self, emoji):
+        await self._fake.rest("add_reaction")
+        self.react(str(emoji), self.guild.me.id)
+
+    async def edit(self, **fields):
+        await self._fake.rest("edit_message")
+        if "content" in fields:
+            self.content = self.clean_content = fields["content"]
+        if fields.get("embed") is not None:
+            self.embeds = [fields["embed"]]
+
+    async def delete(self, *, delay=None):
+        # pylint: disable=unused-argument
+        await self._fake.rest("delete_message")
+        self.channel.messages.pop(self.id, None)
+
+class FakeCategory:
+    """
+    A channel category
+    """
+
+    def __init__(self, guild, cid, name):
+        self.guild = guild
+        self.id = cid
+        self.name = name
+        self.overwrites = {}
+
+    @property
+    def channels(self):
+        return [c for c in self.guild.text_channels if c.category_id == self.id]
+
+class FakeTextChannel:
+    """
+    A guild text channel, with its message history
+    """
+
+    def __init__(self, guild, cid, name, *, category=None, overwrites=None):
+        self._fake = guild._fake
+        self.guild = guild
+        self.id = cid
+        self.name = name
+        self.category_id = category.id if category else None
+        self.overwrites = dict(overwrites or {})
+        self.messages = {}
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return f"<#{self.id}>"
+
+    @property
+    def category(self):
+        return self.guild.get_channel(self.category_id)
+
+    def post(self, author, content: str, *, mid=None) -> FakeMessage:
+        """
+        Put a message into history without going through REST, as though
+        someone else sent it
+        """
+        msg = FakeMessage(self._fake, self, author, content, mid=mid)
+        self.messages[msg.id] = msg
+        return msg
+
+    def permissions_for(self, member):
+        # pylint: disable=unused-argument
+        return discord.Permissions.none()
+
+    async def fetch_message(self, mid):
+        await self._fake.rest("fetch_message")
+        try:
+            return self.messages[mid]
+        except KeyError:
+            raise self._fake.not_found("Message")
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        # pylint: disable=unused-argument
+        await self._fake.rest("send_message")
+        msg = self.post(self.guild.me, content or "")
+        if embed is not None:
+            msg.embeds = [embed]
+        return msg
+
+    async def set_permissions(self, target, *, overwrite=_MISSING, reason=None, **perms):
+        # pylint: disable=unused-argument
+        await self._fake.rest("edit_channel_permissions")
+        if overwrite is _MISSING:
+            overwrite = discord.PermissionOverwrite(**perms)
+        if overwrite is None:
+            self.overwrites.pop(target, None)
+        else:
+            self.overwrites[target] = overwrite
+        self.guild.dispatch_channel_update(self)
+
+    async def edit(self, *, reason=None, **options):
+        # pylint: disable=unused-argument
+        await self._fake.rest("edit_channel")
+        if "name" in options:
+            self.name = options["name"]
+        if "category" in options:
+            category = options["category"]
+            self.category_id = category.id if category else None
+            if options.get("sync_permissions") and category is not None:
+                self.overwrites = dict(category.overwrites)
+        if options.get("overwrites"):
+            self.overwrites = dict(options["overwrites"])
+        self.guild.dispatch_channel_update(self)
+
+    async def delete(self, *, reason=None):
+        # pylint: disable=unused-argument
+        await self._fake.rest("delete_channel")
+        self.guild.remove_channel(self)
+
+    async def history(self, *, limit=100, before=None, after=None, oldest_first=None):
+        """
+        Page through history, one REST call per 100 messages
+        """
+        ids = sorted(self.messages, reverse=not oldest_first)
+        if before is not None:
+            ids = [i for i in ids if i < before.id]
+        if after is not None:
+            ids = [i for i in ids if i > after.id]
+        if limit is not None:
+            ids = ids[:limit]
+        for idx, mid in enumerate(ids):
+            if idx % 100 == 0:
+                await self._fake.rest("get_messages")
+            if mid in self.messages:
+                yield self.messages[mid]
+
+    def typing(self):
+        return _NullTyping()
+
+class _NullTyping:
+    # pylint: disable=too-few-public-methods
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, _exc_type, _exc, _tb):
+        pass
+
+class FakeGuild:
+    """
+    A guild, holding its channels and members
+    """
+
+    def __init__(self, fake, gid, name):
+        self._fake = fake
+        self.id = gid
+        self.name = name
+        self.me = None
+        self.default_role = FakeRole(gid, "@everyone")
+        self._members = {}
+        self._channels = {}
+        self.bot = None
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    @property
+    def text_channels(self):
+        return [c for c in self._channels.values() if isinstance(c, FakeTextChannel)]
+
+    @property
+    def categories(self):
+        return [c for c in self._channels.values() if isinstance(c, FakeCategory)]
+
+    def add_member(self, user: discord.User) -> FakeMember:
+        """
+        Add a user to this guild
+        """
+        member = FakeMember(user, self)
+        self._members[user.id] = member
+        return member
+
+    def get_member(self, uid):
+        return self._members.get(uid)
+
+    def get_channel(self, cid):
+        return self._channels.get(cid)
+
+    def category(self, name: str, *, cid: int = None) -> FakeCategory:
+        """
+        Create a category without going through REST
+        """
+        cat = FakeCategory(self, cid or self._fake.snowflake(), name)
+        self._channels[cat.id] = cat
+        self._fake.channels[cat.id] = cat
+        return cat
+
+    def text_channel(self, name: str, *, category=None, overwrites=None,
+                     cid: int = None) -> FakeTextChannel:
+        """
+        Create a text channel without going through REST
+        """
+        chan = FakeTextChannel(self, cid or self._fake.snowflake(), name,
+                               category=category, overwrites=overwrites)
+        self._channels[chan.id] = chan
+        self._fake.channels[chan.id] = chan
+        return chan
+
+    def remove_channel(self, chan):
+        """
+        Drop a channel, as though it were deleted
+        """
+        self._channels.pop(chan.id, None)
+        self._fake.channels.pop(chan.id, None)
+        if self.bot is not None:
+            self.bot.dispatch("guild_channel_delete", chan)
+
+    def dispatch_channel_update(self, chan):
+        """
+        Let the bot know a channel changed, like the gateway would
+        """
+        if self.bot is not None:
+            self.bot.dispatch("guild_channel_update", chan, chan)
+
+    async def create_text_channel(self, name, *, overwrites=None, category=None,
+                                  reason=None, **options):
+        # pylint: disable=unused-argument
+        await self._fake.rest("create_channel")
+        chan = self.text_channel(name, category=category, overwrites=overwrites)
+        if self.bot is not None:
+            self.bot.dispatch("guild_channel_create", chan)
+        return chan
+
+class FakeBot(commands.GroupMixin):
+    """
+    Enough of commands.Bot for fragments to attach to
+    """
+
+    def __init__(self, fake: FakeDiscord, *, owner: discord.User = None):
+        commands.GroupMixin.__init__(self)
+        self._fake = fake
+        self.loop = asyncio.get_event_loop()
+        self.user = fake.user("bot", bot=True)
+        self.owner = owner or fake.user("owner")
+        self.extra_events = collections.defaultdict(list)
+        self.guilds = []
+        self.pending = set()
+        self._extensions = {}
+
+    def attach(self, guild: FakeGuild):
+        """
+        Make a guild visible to the bot
+        """
+        guild.bot = self
+        self.guilds.append(guild)
+
+    def add_listener(self, func, name=None):
+        self.extra_events[name or func.__name__].append(func)
+
+    def remove_listener(self, func, name=None):
+        name = name or func.__name__
+        if func in self.extra_events[name]:
+            self.extra_events[name].remove(func)
+
+    @property
+    def extensions(self):
+        return types.MappingProxyType(self._extensions)
+
+    def load_extension(self, name):
+        """
+        Like discord.py, import a module and call its `setup`
+        """
+        module = importlib.import_module(name)
+        module.setup(self)
+        self._extensions[name] = module
+
+    def unload_extension(self, name):
+        """
+        Like discord.py, call a module's `teardown` and forget the module, so
+        it's imported again next time
+        """
+        module = self._extensions.pop(name)
+        module.teardown(self)
+        del sys.modules[name]
+
+    def reload_extension(self, name):
+        self.unload_extension(name)
+        self.load_extension(name)
+
+    def dispatch(self, event, *args, **kwargs):
+        """
+        Like discord.py, spawn a task for every listener of an event
+        """
+        tasks = []
+        for func in self.extra_events["on_" + event]:
+            task = self.loop.create_task(func(*args, **kwargs))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+            tasks.append(task)
+        return tasks
+
+    async def drain(self):
+        """
+        Wait for all dispatched events to finish
+        """
+        while self.pending:
+            await asyncio.gather(*list(self.pending))
+
+    def is_ready(self):
+        return True
+
+    async def wait_until_ready(self):
+        pass
+
+    async def wait_for(self, event, *, check=None, timeout=None):
+        # pylint: disable=unused-argument
+        # Nobody in the fake ever reacts or replies
+        raise asyncio.TimeoutError()
+
+    async def is_owner(self, user):
+        return user.id == self.owner.id
+
+    async def application_info(self):
+        await self._fake.rest("application_info")
+        return _AppInfo(self.owner)
+
+    def get_user(self, uid):
+        return self._fake.users.get(uid)
+
+    async def fetch_user(self, uid):
+        await self._fake.rest("fetch_user")
+        try:
+            return self._fake.users[uid]
+        except KeyError:
+            raise self._fake.not_found("User")
+
+    def get_channel(self, cid):
+        return self._fake.channels.get(cid)
+
+    async def fetch_channel(self, cid):
+        await self._fake.rest("fetch_channel")
+        try:
+            return self._fake.channels[cid]
+        except KeyError:
+            raise self._fake.not_found("Channel")
+
+    def get_guild(self, gid):
+        return self._fake.guilds.get(gid)
+
+class _AppInfo:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, owner):
+        self.owner = owner
+
+class FakeContext:
+    """
+    The subset of commands.Context that our commands use
+    """
+
+    def __init__(self, bot: FakeBot, message: FakeMessage):
+        self.bot = bot
+        self.message = message
+        self.channel = message.channel
+        self.guild = message.guild
+        self.author = message.author
+        self.invoked_subcommand = None
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        msg = await self.channel.send(content, **kwargs)
+        self.sent.append(msg)
+        return msg
+
+def reaction_payload(message: FakeMessage, user_id: int, emoji: str,
+                     event_type: str = "REACTION_ADD") -> discord.RawReactionActionEvent:
+    """
+    Build the raw payload the gateway would send for a reaction
+    """
+    return discord.RawReactionActionEvent({
+        "message_id": message.id,
+        "channel_id": message.channel.id,
+        "guild_id": message.guild.id,
+        "user_id": user_id,
+        }, discord.PartialEmoji(name=emoji), event_type)
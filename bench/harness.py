@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+Plumbing shared by the workloads: the fake environment and measurements.
+"""
+
+import logging
+import time
+import typing
+
+from base import resolver, sql
+
+from . import fake
+
+_L = logging.getLogger(__name__)
+
+FRAGMENTS = ["karma", "pin", "managed_cat", "reconcile", "retention", "backup"]
+
+class Env:
+    """
+    A fake bot with the fragments attached, plus a guild to play in
+    """
+
+    def __init__(self, *, latency: float = 0.0, jitter: float = 0.0,
+                 fragments: typing.Iterable[str] = FRAGMENTS):
+        self.fake = fake.FakeDiscord(latency=latency, jitter=jitter)
+        self.bot = fake.FakeBot(self.fake)
+        self.guild = self.fake.guild("bench", self.bot.user)
+        self.bot.attach(self.guild)
+
+        # A fresh database, with whichever engine bootstrap configured
+        sql.init()
+        resolver.setup(self.bot)
+        for name in fragments:
+            self.bot.load_extension(name)
+
+    @property
+    def modules(self):
+        """
+        The fragments' modules by name, as of their last reload
+        """
+        return self.bot.extensions
+
+    def users(self, count: int, prefix: str = "user") -> typing.List[fake.FakeMember]:
+        """
+        Create some members of the guild
+        """
+        return [self.guild.add_member(self.fake.user(f"{prefix}{i}"))
+                for i in range(count)]
+
+    def context(self, channel, author, content: str = "") -> fake.FakeContext:
+        """
+        Make a command context, as though `author` sent `content` in `channel`
+        """
+        return fake.FakeContext(self.bot, channel.post(author, content))
+
+class Measurement:
+    """
+    Latencies and REST calls for one workload
+    """
+
+    def __init__(self, env: Env):
+        self.env = env
+        self.latencies = []
+        self.events = 0
+        self._start = None
+        self._rest_start = 0
+        self.elapsed = 0.0
+        self.rest = 0
+
+    def __enter__(self):
+        self._rest_start = self.env.fake.rest_total()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, _exc_type, _exc, _tb):
+        self.elapsed = time.perf_counter() - self._start
+        self.rest = self.env.fake.rest_total() - self._rest_start
+
+    async def timed(self, coro):
+        """
+        Await something, recording it as a single event
+        """
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+            self.events += 1
+
+    def summary(self) -> dict:
+        """
+        Reduce to the numbers we report and save
+        """
+        lat = sorted(self.latencies)
+        return {
+            "events": self.events,
+            "events_per_sec": self.events / self.elapsed if self.elapsed else 0.0,
+            "p50_ms": percentile(lat, 50) * 1000,
+            "p90_ms": percentile(lat, 90) * 1000,
+            "p99_ms": percentile(lat, 99) * 1000,
+            "max_ms": (lat[-1] if lat else 0.0) * 1000,
+            "rest_per_event": self.rest / self.events if self.events else 0.0,
+        }
+
+def percentile(ordered: typing.List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
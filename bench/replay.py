@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+Replay a gateway recording (made with the `record` option in config.yaml)
+against the fragments, using the fake REST layer and a scratch database.
+
+    python -m bench.replay recordings/gateway-*.jsonl.gz
+    python -m bench.replay --speed original --db srv.0.db recording.jsonl.gz
+    python -m bench.replay --engine memory recordings/gateway-*.jsonl.gz
+
+With `--speed max` (the default) events are dispatched as fast as the event
+loop will take them. Otherwise, the original gaps between events are kept,
+divided by the speed factor (`original` is 1).
+
+Recordings made with `record.anonymize` on have their IDs replaced, so they
+won't line up with the settings (managed categories and so on) in `--db`.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+from bench import fake, scratch_dir
+
+_L = logging.getLogger("bench.replay")
+
+class Replayer:
+    """
+    Turns recorded dispatch events into fake state plus listener calls
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.fake = env.fake
+        self.skipped = 0
+
+    def guild(self, gid) -> fake.FakeGuild:
+        gid = int(gid)
+        guild = self.fake.guilds.get(gid)
+        if guild is None:
+            guild = self.fake.guild(f"guild-{gid}", self.env.bot.user, gid=gid)
+            self.env.bot.attach(guild)
+        return guild
+
+    def user(self, uid, data: dict = None):
+        uid = int(uid)
+        user = self.fake.users.get(uid)
+        if user is None:
+            data = data or {}
+            user = self.fake.user(data.get("username", f"user-{uid}"),
+                                  bot=data.get("bot", False), uid=uid)
+        return user
+
+    def member(self, guild, uid, data: dict = None):
+        member = guild.get_member(int(uid))
+        if member is None:
+            member = guild.add_member(self.user(uid, data))
+        return member
+
+    def channel(self, guild, cid, name: str = None):
+        cid = int(cid)
+        chan = guild.get_channel(cid)
+        if chan is None:
+            chan = guild.text_channel(name or f"channel-{cid}", cid=cid)
+        return chan
+
+    def message(self, chan, mid, author=None):
+        mid = int(mid)
+        msg = chan.messages.get(mid)
+        if msg is None:
+            # Sent before the recording started, so we don't know who by
+            if author is None:
+                author = self.member(chan.guild, self.fake.snowflake(),
+                                     {"username": f"author-of-{mid}"})
+            msg = chan.post(author, "", mid=mid)
+        return msg
+
+    def apply(self, event: str, data: dict):
+        """
+        Update fake state for an event, returning the (event, args) to
+        dispatch, or None if there's nothing to dispatch
+        """
+        handler = getattr(self, "on_" + event.lower(), None)
+        if handler is None or "guild_id" not in data and event != "GUILD_CREATE":
+            self.skipped += 1
+            return None
+        return handler(data)
+
+    def on_guild_create(self, data):
+        guild = self.guild(data["id"])
+        for chan in data.get("channels", []):
+            if chan.get("type") == 4:
+                if guild.get_channel(int(chan["id"])) is None:
+                    guild.category(chan["name"], cid=int(chan["id"]))
+        for chan in data.get("channels", []):
+            if chan.get("type") == 0:
+                parent = chan.get("parent_id")
+                self.channel(guild, chan["id"], chan["name"]).category_id = (
+                    int(parent) if parent else None)
+        for member in data.get("members", []):
+            self.member(guild, member["user"]["id"], member["user"])
+        return None
+
+    def on_message_create(self, data):
+        guild = self.guild(data["guild_id"])
+        chan = self.channel(guild, data["channel_id"])
+        author = self.member(guild, data["author"]["id"], data["author"])
+        msg = self.message(chan, data["id"], author)
+        msg.content = msg.clean_content = data.get("content", "")
+        return ("message", (msg,))
+
+    def on_message_delete(self, data):
+        guild = self.guild(data["guild_id"])
+        chan = self.channel(guild, data["channel_id"])
+        chan.messages.pop(int(data["id"]), None)
+        return None
+
+    def _reaction(self, data, event_type):
+        guild = self.guild(data["guild_id"])
+        chan = self.channel(guild, data["channel_id"])
+        self.member(guild, data["user_id"], (data.get("member") or {}).get("user"))
+        msg = self.message(chan, data["message_id"])
+        emoji = data["emoji"]["name"]
+        if event_type == "REACTION_ADD":
+            msg.react(emoji, int(data["user_id"]))
+            name = "raw_reaction_add"
+        else:
+            msg.unreact(emoji, int(data["user_id"]))
+            name = "raw_reaction_remove"
+        payload = fake.reaction_payload(msg, int(data["user_id"]), emoji, event_type)
+        return (name, (payload,))
+
+    def on_message_reaction_add(self, data):
+        return self._reaction(data, "REACTION_ADD")
+
+    def on_message_reaction_remove(self, data):
+        return self._reaction(data, "REACTION_REMOVE")
+
+async def replay(env, paths, speed: float):
+    """
+    Feed recordings through the fragments, returning the measurement
+    """
+    # pylint: disable=import-outside-toplevel
+    from base import recorder
+    from bench.harness import Measurement
+
+    replayer = Replayer(env)
+    inflight = []
+
+    async def dispatch(name, args):
+        results = await asyncio.gather(*env.bot.dispatch(name, *args))
+        await asyncio.gather(*[res for res in results if asyncio.isfuture(res)])
+
+    with Measurement(env) as measure:
+        first = None
+        start = time.perf_counter()
+        for path in paths:
+            for entry in recorder.read(path):
+                if speed > 0:
+                    if first is None:
+                        first = entry["ts"]
+                    delay = start + (entry["ts"] - first) / speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                todo = replayer.apply(entry["t"], entry["d"])
+                if todo is not None:
+                    inflight.append(env.bot.loop.create_task(measure.timed(dispatch(*todo))))
+                # Let the gateway "read" the next event, like the real one
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*inflight)
+        await env.bot.drain()
+
+    _L.info("skipped %d events with no replay handler", replayer.skipped)
+    return measure
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.replay", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="+", help="recording files, in order")
+    parser.add_argument("--speed", default="max",
+                        help="'max', 'original', or a multiple of original speed")
+    parser.add_argument("--db", default=None,
+                        help="database to start from (a scratch copy is used)")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="fake REST latency in seconds (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=("file", "memory"), default="file",
+                        help="database backend (default %(default)s)")
+    args = parser.parse_args()
+
+    speed = {"max": 0.0, "original": 1.0}.get(args.speed)
+    if speed is None:
+        speed = float(args.speed)
+
+    logging.basicConfig(level=logging.WARNING)
+    _L.setLevel(logging.INFO)
+    random.seed(args.seed)
+
+    # we're about to change directory
+    recordings = [os.path.abspath(path) for path in args.recordings]
+
+    with scratch_dir(args.db, args.engine):
+        # pylint: disable=import-outside-toplevel
+        from bench.harness import Env
+
+        async def run():
+            env = Env(latency=args.latency)
+            return env, await replay(env, recordings, speed)
+
+        env, measure = asyncio.get_event_loop().run_until_complete(run())
+
+    for key, value in measure.summary().items():
+        print(f"{key:>16}: {value:.2f}")
+    for route, count in sorted(env.fake.calls.items()):
+        print(f"{'REST ' + route:>32}: {count}")
+
+if __name__ == "__main__":
+    sys.exit(main())
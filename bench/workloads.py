@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic workloads. Each one sets up its own channels and users in the shared
+environment, then measures a batch of events or commands.
+"""
+
+import asyncio
+import datetime
+import random
+
+import discord
+
+from base import fragment, settings, sql
+
+from . import fake
+from .harness import Env, Measurement
+
+WORKLOADS = {}
+
+def workload(name: str):
+    """
+    Decorator - register a workload under a name
+    """
+    def decorate(func):
+        WORKLOADS[name] = func
+        return func
+    return decorate
+
+async def burst(measure: Measurement, coros, width: int):
+    """
+    Run coroutines `width` at a time, each measured as one event
+    """
+    coros = list(coros)
+    for start in range(0, len(coros), width):
+        await asyncio.gather(*(measure.timed(c) for c in coros[start:start+width]))
+
+async def gateway(env: Env, event: str, *args):
+    """
+    Dispatch an event, finishing when all its listeners have
+    """
+    results = await asyncio.gather(*env.bot.dispatch(event, *args))
+    # Listeners with a dispatch policy return a future for the actual work
+    await asyncio.gather(*[res for res in results if asyncio.isfuture(res)])
+
+def enable_fragments(env: Env, pin_channel: int):
+    """
+    Turn on karma and pinning for the whole guild
+    """
+    guild = env.guild.id
+    settings.set_stored("enable_karma", True, server=guild)
+    settings.set_stored("pin_channel", pin_channel, server=guild)
+    settings.set_stored("pin_threshhold", 3, server=guild)
+
+@workload("reactions.mixed")
+async def reactions_mixed(env: Env, scale: int) -> Measurement:
+    """
+    Votes, other reactions and stars across a busy channel
+    """
+    board = env.guild.text_channel("pinboard")
+    chan = env.guild.text_channel("general")
+    enable_fragments(env, board.id)
+
+    authors = env.users(10, "author")
+    voters = env.users(50, "voter")
+    messages = [chan.post(random.choice(authors), f"message {i}") for i in range(20)]
+    emojis = ["🔺"] * 6 + ["🔻"] * 2 + ["👍", "⭐"]
+
+    def events():
+        for _ in range(scale):
+            msg = random.choice(messages)
+            voter = random.choice(voters)
+            emoji = random.choice(emojis)
+            msg.react(emoji, voter.id)
+            yield gateway(env, "raw_reaction_add", fake.reaction_payload(msg, voter.id, emoji))
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 50)
+    return measure
+
+@workload("reactions.remove")
+async def reactions_remove(env: Env, scale: int) -> Measurement:
+    """
+    Reaction removals, which each delete a karma row
+    """
+    board = env.guild.text_channel("pinboard")
+    chan = env.guild.text_channel("general")
+    enable_fragments(env, board.id)
+
+    author, = env.users(1, "author")
+    voters = env.users(scale, "voter")
+    msg = chan.post(author, "controversial")
+
+    for voter in voters:
+        msg.react("🔺", voter.id)
+        await gateway(env, "raw_reaction_add", fake.reaction_payload(msg, voter.id, "🔺"))
+
+    def events():
+        for voter in voters:
+            msg.unreact("🔺", voter.id)
+            yield gateway(env, "raw_reaction_remove",
+                          fake.reaction_payload(msg, voter.id, "🔺", "REACTION_REMOVE"))
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 50)
+    return measure
+
+@workload("pin.star_storm")
+async def pin_star_storm(env: Env, scale: int) -> Measurement:
+    """
+    A single message going viral on the pinboard
+    """
+    board = env.guild.text_channel("pinboard")
+    chan = env.guild.text_channel("general")
+    enable_fragments(env, board.id)
+
+    author, = env.users(1, "author")
+    fans = env.users(scale, "fan")
+    msg = chan.post(author, "a very good message")
+
+    def events():
+        for fan in fans:
+            msg.react("⭐", fan.id)
+            yield gateway(env, "raw_reaction_add", fake.reaction_payload(msg, fan.id, "⭐"))
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 50)
+    return measure
+
+@workload("karma.commands")
+async def karma_commands(env: Env, scale: int) -> Measurement:
+    """
+    People checking their karma and the leaderboard
+    """
+    chan = env.guild.text_channel("bot-spam")
+    users = env.users(20, "asker")
+
+    get_karma = env.bot.get_command("karma")
+    ktop = env.bot.get_command("ktop")
+
+    def events():
+        for idx in range(scale):
+            ctx = env.context(chan, users[idx % len(users)], "karma")
+            if idx % 2:
+                yield get_karma.callback(ctx)
+            else:
+                yield ktop.callback(ctx)
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 10)
+    return measure
+
+@workload("settings.lookup")
+async def settings_lookup(env: Env, scale: int) -> Measurement:
+    """
+    Channel setting reads with a server-wide fallback
+    """
+    chan = env.guild.text_channel("settings")
+    author, = env.users(1, "author")
+    msg = chan.post(author, "hi")
+    setting = env.modules["karma"].enable
+
+    with Measurement(env) as measure:
+        for _ in range(scale):
+            await measure.timed(setting.get(msg))
+    return measure
+
+@workload("sql.query")
+async def sql_query(env: Env, scale: int) -> Measurement:
+    """
+    Raw karma inserts (and their aggregate triggers) interleaved with
+    leaderboard reads
+    """
+    async def write(idx):
+        sql.query("""
+            INSERT OR IGNORE INTO karma(giver, message, kind, delta, receiver)
+            VALUES (?, ?, 1, 1, ?)
+            """, idx, idx // 10, idx % 97)
+
+    async def read():
+        sql.query("""
+            SELECT receiver, votes + anyreact AS net FROM karma_totals
+            ORDER BY votes + anyreact DESC LIMIT 10
+            """)
+
+    def events():
+        for idx in range(scale):
+            yield read() if idx % 10 == 0 else write(idx)
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 10)
+    return measure
+
+@workload("managed_cat.commands")
+async def managed_cat_commands(env: Env, scale: int) -> Measurement:
+    """
+    Listing, joining and leaving a large managed category
+    """
+    from discord import PermissionOverwrite
+
+    guild = env.guild
+    cat = guild.category("managed")
+    dead = guild.category("dead")
+    settings.set_stored("managed_cat", cat.id, server=guild.id)
+    settings.set_stored("dead_cat", dead.id, server=guild.id)
+
+    users = env.users(40, "member")
+    base = {
+        guild.default_role: PermissionOverwrite(read_messages=False),
+        guild.me: PermissionOverwrite(read_messages=True),
+    }
+    channels = []
+    for idx in range(30):
+        overwrites = dict(base)
+        for user in random.sample(users, 20):
+            overwrites[user] = PermissionOverwrite(read_messages=True, send_messages=True)
+        channels.append(guild.text_channel(f"topic-{idx}", category=cat, overwrites=overwrites))
+
+    lobby = guild.text_channel("lobby")
+    mod = env.modules["managed_cat"]
+
+    def events():
+        for idx in range(scale):
+            user = users[idx % len(users)]
+            chan = channels[idx % len(channels)]
+            which = idx % 5
+            if which == 0:
+                yield mod.list_channels.callback(env.context(lobby, user))
+            elif which == 1:
+                yield mod.whosin.callback(env.context(lobby, user), channame=chan.name)
+            elif which == 2:
+                yield mod.join.callback(env.context(lobby, user), channame=chan.name)
+            elif which == 3:
+                yield mod.view.callback(env.context(lobby, user), channame=chan.name)
+            else:
+                yield mod.leave.callback(env.context(lobby, user), channame=chan.name)
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 10)
+    return measure
+
+@workload("managed_cat.signup_rush")
+async def managed_cat_signup_rush(env: Env, scale: int) -> Measurement:
+    """
+    Lots of people joining a handful of brand new channels at once
+    """
+    guild = env.guild
+    cat = guild.category("rush")
+    settings.set_stored("managed_cat", cat.id, server=guild.id)
+
+    users = env.users(scale, "signup")
+    lobby = guild.text_channel("rush-lobby")
+    mod = env.modules["managed_cat"]
+
+    def events():
+        for idx, user in enumerate(users):
+            yield mod.join.callback(env.context(lobby, user), channame=f"event-{idx % 5}")
+
+    with Measurement(env) as measure:
+        await burst(measure, events(), 50)
+    return measure
+
+@workload("reconcile.backfill")
+async def reconcile_backfill(env: Env, scale: int) -> Measurement:
+    """
+    Catching up on votes given while offline, one event per channel of 100
+    messages
+    """
+    board = env.guild.text_channel("missed-pinboard")
+    enable_fragments(env, board.id)
+    authors = env.users(10, "poster")
+    voters = env.users(5, "missed")
+    mod = env.modules["reconcile"]
+
+    channels = []
+    for idx in range(max(1, scale // 100)):
+        chan = env.guild.text_channel(f"missed-{idx}")
+        for num in range(100):
+            msg = chan.post(authors[num % len(authors)], f"message {num}")
+            for voter in voters[:num % 4]:
+                msg.react("🔺", voter.id)
+        channels.append(chan)
+
+    until = env.fake.snowflake()
+    budget = mod.Budget(1 << 30)
+    fetches = asyncio.Semaphore(4)
+
+    with Measurement(env) as measure:
+        await burst(measure, (mod.reconcile_channel(chan, until, budget, fetches)
+                              for chan in channels), 2)
+    return measure
+
+@workload("retention.archive")
+async def retention_archive(env: Env, scale: int) -> Measurement:
+    """
+    Moving votes on old messages to the archive, one event per batch
+    """
+    mod = env.modules["retention"]
+    start = discord.utils.time_snowflake(datetime.datetime(2016, 1, 1))
+    sql.database().executemany("""
+        INSERT OR IGNORE INTO karma(giver, message, kind, delta, receiver)
+        VALUES (?, ?, 1, 1, ?)
+        """, [(idx % 50, start + ((idx // 50) << 22), idx % 97) for idx in range(scale * 10)])
+    cutoff = start + ((scale * 10 // 50 + 1) << 22)
+    env.modules["karma"].fold(cutoff)
+
+    with Measurement(env) as measure:
+        while await measure.timed(mod.archive_batch("karma", "message", cutoff)):
+            pass
+    return measure
+
+@workload("backup.during_votes")
+async def backup_during_votes(env: Env, scale: int) -> Measurement:
+    """
+    Votes coming in while the database is being backed up over and over
+    """
+    board = env.guild.text_channel("backup-pinboard")
+    chan = env.guild.text_channel("backup-general")
+    enable_fragments(env, board.id)
+    mod = env.modules["backup"]
+
+    # Enough old votes that a backup takes a few steps
+    start = discord.utils.time_snowflake(datetime.datetime(2017, 1, 1))
+    sql.database().executemany("""
+        INSERT OR IGNORE INTO karma(giver, message, kind, delta, receiver)
+        VALUES (?, ?, 1, 1, ?)
+        """, [(idx % 500, start + ((idx // 500) << 22), idx % 997) for idx in range(scale * 200)])
+
+    authors = env.users(10, "backed-up")
+    voters = env.users(50, "backup-voter")
+    messages = [chan.post(random.choice(authors), f"message {i}") for i in range(20)]
+
+    def events():
+        for _ in range(scale):
+            msg = random.choice(messages)
+            voter = random.choice(voters)
+            msg.react("🔺", voter.id)
+            yield gateway(env, "raw_reaction_add", fake.reaction_payload(msg, voter.id, "🔺"))
+
+    done = False
+    async def back_up():
+        while not done:
+            await mod.start()[1]
+
+    with Measurement(env) as measure:
+        backups = asyncio.ensure_future(back_up())
+        await burst(measure, events(), 50)
+    done = True
+    await backups
+    return measure
+
+@workload("fragment.reload")
+async def fragment_reload(env: Env, scale: int) -> Measurement:
+    """
+    Reloading karma (and the fragments which use it) while votes come in,
+    one event per reload
+    """
+    board = env.guild.text_channel("reload-pinboard")
+    chan = env.guild.text_channel("reload-general")
+    enable_fragments(env, board.id)
+
+    author, = env.users(1, "reloaded")
+    voters = env.users(max(1, scale // 20), "reload-voter")
+    msg = chan.post(author, "hot off the press")
+    listeners = {name: len(funcs) for name, funcs in env.bot.extra_events.items()}
+
+    async def reload():
+        fragment.reload(env.bot, "karma")
+
+    with Measurement(env) as measure:
+        for voter in voters:
+            await measure.timed(reload())
+            msg.react("🔺", voter.id)
+            await gateway(env, "raw_reaction_add", fake.reaction_payload(msg, voter.id, "🔺"))
+
+    leaked = {name: len(funcs) - listeners.get(name, 0)
+              for name, funcs in env.bot.extra_events.items() if len(funcs) != listeners.get(name, 0)}
+    if leaked:
+        raise RuntimeError(f"listeners left behind by reloads: {leaked}")
+    total = await env.modules["karma"].total_for(author.id)
+    if total != len(voters):
+        raise RuntimeError(f"votes lost across reloads: {total}/{len(voters)}")
+    return measure
@@ -4,24 +4,58 @@
 Main bot client
 """
 
-import datetime
 import logging
 import logging.config
 import random
 import sys
-import traceback
+import typing
 
 import discord
 from discord.ext import commands
 
-from base import config
+from base import config, embeds, outbound, recorder, reporter, settings, sql
 
 if __name__ != "__main__":
     raise RuntimeError("client being imported")
 
 _L = logging.getLogger(__name__)
 
-bot = commands.Bot(command_prefix=commands.when_mentioned)
+class Bot(commands.Bot):
+    """
+    Bot which counts changes to its command set, so things derived from it
+    (e.g. help) know when to be rebuilt
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Set first, as the base constructor adds the default help command
+        self.command_generation = 0
+        super().__init__(*args, **kwargs)
+
+    def add_command(self, command):
+        super().add_command(command)
+        self.command_generation += 1
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        if command is not None:
+            self.command_generation += 1
+        return command
+
+bot = Bot(command_prefix=commands.when_mentioned)
+
+errors = reporter.Reporter(
+    bot,
+    window=config.get("errors.digest_seconds"),
+    max_pending=config.get("errors.max_pending"),
+    delete_after=config.get("errors.delete_after"))
+
+@bot.before_invoke
+async def count_command(ctx: commands.Context):
+    """
+    Most commands reply, so hold background sends back a little for them
+    """
+    # pylint: disable=unused-argument
+    outbound.SCHEDULER.spend()
 
 @bot.event
 async def on_command_error(ctx: commands.Context, error: Exception):
@@ -31,11 +65,10 @@ async def on_command_error(ctx: commands.Context, error: Exception):
     # Un-nest
     error = getattr(error, 'original', error)
 
-    async def report_to_owner():
+    def report_to_owner():
         _L.error("exception from command %s", ctx.invoked_with, exc_info=error)
-        exc_traceback = "".join(traceback.format_exception(type(error), error, error.__traceback__))
-        await (await bot.application_info()).owner.send(
-            f"\u200bISE! {datetime.datetime.now()}\n```\n{exc_traceback} ```", delete_after=60)
+        errors.report(f"command `{ctx.invoked_with}`",
+                      (type(error), error, error.__traceback__))
 
     # Handle exceptions from user behaviour
     if isinstance(error, commands.CommandOnCooldown):
@@ -62,11 +95,11 @@ async def on_command_error(ctx: commands.Context, error: Exception):
             await ctx.send(f"\u200b:no_entry: This bot is missing permissions (code {error.code})")
         # pylint: disable=bare-except
         except:
-            await report_to_owner()
+            report_to_owner()
 
     else:
         await ctx.send("```diff\n-- 500 Internal Server Error --```", delete_after=60)
-        await report_to_owner()
+        report_to_owner()
 
 
 @bot.event
@@ -80,9 +113,56 @@ async def on_error(event, *args, **kwargs):
     if isinstance(exc, discord.errors.Forbidden):
         return # don't raise permission errors
 
-    exc_traceback = "".join(traceback.format_exception(*sys.exc_info()))
-    await (await bot.application_info()).owner.send(
-        f"\u200bISE! {datetime.datetime.now()}\n```\n{exc_traceback}", delete_after=60)
+    errors.report(f"event `{event}`", sys.exc_info())
+
+# (guild id, permission bucket) -> (command generation, pages)
+_HELP_CACHE: typing.Dict[typing.Tuple[typing.Optional[int], str],
+                         typing.Tuple[int, typing.List[discord.Embed]]] = {}
+# Bumped on invalidation, so help built across a settings change isn't cached
+_HELP_INVALIDATIONS = 0
+
+async def help_bucket(ctx: commands.Context) -> str:
+    """
+    Which set of commands someone can see. Checks only depend on this and on
+    server settings, so help can be cached per (server, bucket).
+    """
+    if await bot.is_owner(ctx.author):
+        return "owner"
+    if ctx.guild is not None and ctx.channel.permissions_for(ctx.author).administrator:
+        return "admin"
+    return "member"
+
+@settings.watch
+def invalidate_help(option, server, channel, user):
+    """
+    Settings (e.g. the managed category) decide some checks, so drop cached
+    help for the server when they change
+    """
+    # pylint: disable=unused-argument,global-statement
+    global _HELP_INVALIDATIONS
+    _HELP_INVALIDATIONS += 1
+    for key in [key for key in _HELP_CACHE if server == -1 or key[0] == server]:
+        del _HELP_CACHE[key]
+
+async def build_help(ctx: commands.Context) -> typing.List[discord.Embed]:
+    """
+    Help for all commands the invoker can run
+    """
+    fields = []
+    for com in bot.commands:
+        try:
+            if com.hidden or not com.enabled or not await com.can_run(ctx):
+                continue
+        except commands.CommandError:
+            continue
+
+        fields.append((com.name, com.short_doc or "_No description available_", False))
+
+    return embeds.pack(
+        "Help",
+        description=(bot.description or ""),
+        fields=fields,
+        footer="Run `help <command>` for information on a specific command.")
 
 bot.remove_command("help")
 @bot.command("help")
@@ -92,66 +172,59 @@ async def help_message(ctx: commands.Context, *, command=None):
     """
 
     if command is None:
-        embed = discord.Embed(
-            title="Help",
-            description=(bot.description or "")
-            )
-        embed.set_footer(
-            text="Run `help <command>` for information on a specific command."
-            )
-
-        for com in bot.commands:
-            try:
-                if com.hidden or not com.enabled or not await com.can_run(ctx):
-                    continue
-            except commands.CommandError:
-                continue
-
-            embed.add_field(
-                name=com.name,
-                value=com.short_doc or "_No description available_",
-                inline=False
-                )
+        key = (ctx.guild.id if ctx.guild else None, await help_bucket(ctx))
+        generation = bot.command_generation
+        invalidations = _HELP_INVALIDATIONS
+        cached = _HELP_CACHE.get(key)
+        if cached is not None and cached[0] == generation:
+            pages = cached[1]
+        else:
+            pages = await build_help(ctx)
+            if invalidations == _HELP_INVALIDATIONS:
+                _HELP_CACHE[key] = (generation, pages)
     else:
         com = bot.get_command(command)
         if com is None:
             raise commands.CommandError("Command not found")
 
-        embed = discord.Embed(
-            title=f"Help on {com.qualified_name}"
-            )
-        embed.add_field(
-            name="Usage",
-            value=f"`{com.qualified_name} {com.signature}`",
-            inline=False
-            )
-        embed.add_field(
-            name="Description",
-            value=com.help,
-            inline=False
-            )
+        fields = [
+            ("Usage", f"`{com.qualified_name} {com.signature}`", False),
+            ("Description", com.help, False),
+            ]
         if com.aliases:
-            embed.add_field(
-                name="Aliases",
-                value="\n".join(com.aliases),
-                inline=False
-                )
+            fields.append(("Aliases", "\n".join(com.aliases), False))
+
+        pages = embeds.pack(f"Help on {com.qualified_name}", fields=fields)
 
-    await ctx.send(embed=embed)
+    await embeds.send(ctx, pages, paginate=True)
 
 #
 # set up logger
 #
 
-logging.config.dictConfig(config.get('logging'))
+logging.config.dictConfig(config.thaw(config.get('logging')))
+
+@config.on_change("logging")
+def reconfigure_logging(value):
+    logging.config.dictConfig(config.thaw(value))
 
 #
-# load fragments
+# open the database, then load fragments (which set up their tables)
 #
 
+sql.init()
+
 for mod in config.get("discord.modules"):
     bot.load_extension(mod)
 
+#
+# record gateway events
+#
+
+gateway_recorder = None
+if config.get("record.enabled"):
+    gateway_recorder = recorder.attach(bot, config.get("record"))
+
 #
 # start bot
 #
@@ -161,8 +234,13 @@ async def on_ready():
     """
     Notify of bot being ready
     """
-    appinfo = await bot.application_info()
-    await appinfo.owner.send("`Alive` startup", delete_after=1)
+    owner = await errors.owner()
+    await owner.send("`Alive` startup", delete_after=1)
 
 random.seed()
-bot.run(config.get("secrets.discord-token"))
+try:
+    bot.run(config.get("secrets.discord-token"))
+finally:
+    if gateway_recorder is not None:
+        gateway_recorder.close()
+    sql.close()
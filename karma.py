@@ -2,13 +2,16 @@
 
 import logging
 import enum
+import time
+import typing
 
 import discord
 from discord.ext import commands
 
-from base import sql, fragment, settings, resolver, config
+from base import sql, embeds, fragment, settings, resolver, config
 
 setup = fragment.Fragment()
+teardown = setup.teardown
 _L = logging.getLogger(__name__)
 
 class Kind(enum.IntEnum):
@@ -24,6 +27,91 @@ sql.require_table("karma", """
         receiver INTEGER NOT NULL,
         PRIMARY KEY(giver, message, kind)
         """)
+# Votes on messages before this are final (see `fold`)
+sql.require_table("karma_folded", """
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        before INTEGER NOT NULL
+        """)
+_FOLDED_BEFORE = 0
+
+#
+# Aggregates
+#
+
+# Per-receiver tables, kept up to date by triggers on karma, so totals, ranks
+# and breakdowns don't have to sum over every vote. Keyed by these columns:
+_AGGREGATES = {
+    "karma_totals": ("receiver",),
+    "karma_by_giver": ("receiver", "giver"),
+    "karma_by_message": ("receiver", "message"),
+}
+# Each has these sums, of a karma row called {row}
+_SUMS = {
+    "votes": "CASE WHEN {row}.kind != 2 THEN {row}.delta ELSE 0 END",
+    "anyreact": "CASE WHEN {row}.kind = 2 THEN {row}.delta ELSE 0 END",
+    "up": "{row}.kind = 1",
+    "down": "{row}.kind = 3",
+}
+
+def _require_aggregate(table: str, keys: typing.Tuple[str, ...]):
+    """
+    Create an aggregate table with its triggers and indexes, filling it in
+    from karma if it's new
+    """
+    fresh = not sql.query("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", table)
+    keyed = ", ".join(keys)
+    sums = ", ".join(_SUMS)
+
+    sql.query("SAVEPOINT aggregate")
+    try:
+        sql.require_table(table, "".join(f"{key} INTEGER NOT NULL, " for key in keys)
+                          + "".join(f"{col} INTEGER NOT NULL DEFAULT 0, " for col in _SUMS)
+                          + f"PRIMARY KEY({keyed})")
+        if fresh:
+            sql.query(f"""
+                INSERT INTO {table}({keyed}, {sums})
+                SELECT {keyed}, {", ".join(f"SUM({expr.format(row='karma')})"
+                                           for expr in _SUMS.values())}
+                FROM karma GROUP BY {keyed}
+                """)
+
+        for event, row, sign in (("INSERT", "NEW", ""), ("DELETE", "OLD", "-")):
+            # Replaced each time, so they always match the code
+            trigger = f"{table}_{event.lower()}"
+            sql.query(f"DROP TRIGGER IF EXISTS {trigger}")
+            sql.query(f"""
+                CREATE TRIGGER {trigger} AFTER {event} ON karma
+                WHEN {row}.message >= ifnull((SELECT before FROM karma_folded), 0)
+                BEGIN
+                    INSERT INTO {table}({keyed}, {sums})
+                    VALUES ({", ".join(f"{row}.{key}" for key in keys)},
+                            {", ".join(f"{sign}({expr.format(row=row)})" for expr in _SUMS.values())})
+                    ON CONFLICT({keyed}) DO UPDATE
+                    SET {", ".join(f"{col} = {col} + excluded.{col}" for col in _SUMS)};
+                END
+                """)
+
+        # Ordered by either kind of total, within a receiver for the breakdowns
+        within = "".join(f"{key}, " for key in keys[:-1])
+        sql.query(f"CREATE INDEX IF NOT EXISTS {table}_votes ON {table}({within}votes)")
+        sql.query(f"CREATE INDEX IF NOT EXISTS {table}_score "
+                  f"ON {table}({within}votes + anyreact)")
+    except:
+        sql.query("ROLLBACK TO aggregate")
+        raise
+    finally:
+        sql.query("RELEASE aggregate")
+
+def fold(before: int):
+    """
+    Make votes on messages before `before` final: reactions on them are
+    ignored from now on, and deleting them from karma (to archive them)
+    leaves them counted in the aggregates
+    """
+    global _FOLDED_BEFORE # pylint: disable=global-statement
+    if before > _FOLDED_BEFORE:
+        sql.query("INSERT OR REPLACE INTO karma_folded(id, before) VALUES (0, ?)", before)
+        _FOLDED_BEFORE = before
 
 enable = settings.ServerChannelSetting(
         name="enable_karma",
@@ -34,6 +122,8 @@ downvote = "🔻"
 upvote = "🔺"
 
 async def parse_payload(payload):
+    if payload.message_id < _FOLDED_BEFORE:
+        return None # votes on it are final
     channel = await resolver.fetch_channel_maybe(payload.channel_id)
     if channel is None or isinstance(channel, discord.abc.PrivateChannel):
         return None # Doesn't exist, or is DM channel
@@ -68,7 +158,72 @@ async def parse_payload(payload):
         "receiver": message.author.id
     }
 
-@setup.listen("on_raw_reaction_add")
+def vote_reactions(message: discord.Message) -> typing.List[discord.Reaction]:
+    """
+    The up/downvote reactions on a message
+    """
+    return [reaction for reaction in message.reactions
+            if str(reaction.emoji) in (upvote, downvote)]
+
+async def votes_on(message: discord.Message) -> typing.Set[typing.Tuple[int, Kind, int]]:
+    """
+    Fetch who's up/downvoted a message, as (giver, kind, delta)
+    """
+    votes = set()
+    if message.author.bot:
+        return votes
+    for reaction in vote_reactions(message):
+        if str(reaction.emoji) == upvote:
+            kind, delta = Kind.UPVOTE, 1
+        else:
+            kind, delta = Kind.DOWNVOTE, -1
+        async for user in reaction.users(limit=None):
+            if not user.bot and user.id != message.author.id:
+                votes.add((user.id, kind, delta))
+    return votes
+
+def apply_votes(con, voted: typing.List[typing.Tuple[discord.Message, typing.Set[tuple]]]):
+    """
+    Make the stored up/downvotes on some messages match what `votes_on`
+    found, inside a transaction. Other reactions (anyreact) are left alone.
+
+    Returns the changes made, as (receiver, kind, delta), to pass to
+    `karma_changed` once the transaction is done.
+    """
+    voted = [(message, votes) for message, votes in voted if message.id >= _FOLDED_BEFORE]
+    if not voted:
+        return []
+    by_id = {message.id: message for message, _ in voted}
+    have = {(row[0], row[1], row[2]): (row[3], row[4]) for row in con.execute(f"""
+        SELECT giver, message, kind, delta, receiver FROM karma
+        WHERE kind IN (?, ?) AND message IN ({", ".join("?" * len(by_id))})
+        """, (Kind.UPVOTE, Kind.DOWNVOTE, *by_id)).fetchall()}
+    want = {(giver, message.id, kind): (delta, message.author.id)
+            for message, votes in voted
+            for giver, kind, delta in votes}
+
+    added = want.keys() - have.keys()
+    removed = have.keys() - want.keys()
+    con.executemany("""
+        INSERT OR IGNORE INTO karma(giver, message, kind, delta, receiver)
+        VALUES (?, ?, ?, ?, ?)
+        """, [(*key, *want[key]) for key in added])
+    con.executemany("""
+        DELETE FROM karma
+        WHERE giver=? AND message=? AND kind=?
+        """, list(removed))
+
+    return ([(want[key][1], key[2], want[key][0]) for key in added]
+            + [(have[key][1], key[2], -have[key][0]) for key in removed])
+
+# Someone's add and remove on a message have to be applied in order. Anything
+# past the limit in a flood waits its turn, as a dropped vote stays lost until
+# reconcile happens to look at that message again. Only so many can wait,
+# though; past that, a flood is shed rather than piling up listener tasks.
+reactions = fragment.Dispatch("karma", workers=32, limit=2000, block=True,
+                              key=lambda payload: (payload.message_id, payload.user_id))
+
+@setup.listen("on_raw_reaction_add", dispatch=reactions)
 async def on_reaction_add(payload):
     delta = await parse_payload(payload)
     if delta is None:
@@ -79,8 +234,10 @@ async def on_reaction_add(payload):
             giver, message, kind, delta, receiver
         ) VALUES (:giver, :message, :kind, :delta, :receiver)
         """, **delta)
+    if sql.query("SELECT changes()")[0][0]:
+        karma_changed(delta["receiver"], delta["kind"], delta["delta"])
 
-@setup.listen("on_raw_reaction_remove")
+@setup.listen("on_raw_reaction_remove", dispatch=reactions)
 async def on_reacton_remove(payload):
     delta = await parse_payload(payload)
     if delta is None:
@@ -90,8 +247,215 @@ async def on_reacton_remove(payload):
         DELETE FROM karma
         WHERE giver=:giver AND message=:message AND kind=:kind
         """, **delta)
+    if sql.query("SELECT changes()")[0][0]:
+        karma_changed(delta["receiver"], delta["kind"], -delta["delta"])
+
+#
+# Cached reads
+#
+
+# How long cached karma is trusted, in case the table changes behind our back
+CACHE_TTL = 5 * 60
+TOP_N = 10
+
+# receiver -> (expiry, total)
+_TOTALS: typing.Dict[int, typing.Tuple[float, int]] = {}
+
+class _Top(typing.NamedTuple):
+    expiry: float
+    receivers: typing.List[int]
+    cutoff: float # lowest total on the board
+    pages: typing.List[discord.Embed]
+
+_TOP: typing.Optional[_Top] = None
+# Bumped on every change, so reads that raced with one aren't cached
+_GENERATION = 0
+
+@sql.on_open
+def _schema():
+    """
+    Indexes and aggregates, and state kept from the database, whenever one
+    is opened
+    """
+    global _FOLDED_BEFORE, _TOP # pylint: disable=global-statement
+    sql.query("CREATE INDEX IF NOT EXISTS karma_message ON karma(message)")
+    for table, keys in _AGGREGATES.items():
+        _require_aggregate(table, keys)
+    _FOLDED_BEFORE = next(iter(sql.query("SELECT before FROM karma_folded")), (0,))[0]
+    # Nothing cached is from this database
+    _TOTALS.clear()
+    _TOP = None
+
+# Flags for how karma is counted
+FLAGS = config.key("karma")
+
+@config.on_change("karma")
+def flags_changed(_flags):
+    """
+    Cached karma may have been counted differently
+    """
+    global _TOP, _GENERATION # pylint: disable=global-statement
+    _GENERATION += 1
+    _TOTALS.clear()
+    _TOP = None
+
+def counted(kind: Kind) -> bool:
+    """
+    Whether a kind of vote counts towards karma
+    """
+    return kind != Kind.ANYREACT or "no-anyreact" not in FLAGS.get()
+
+def _score(table: str) -> str:
+    """
+    SQL for a row's karma in an aggregate table, matching its index
+    """
+    if "no-anyreact" in FLAGS.get():
+        return f"{table}.votes"
+    return f"{table}.votes + {table}.anyreact"
+
+def _total_now(receiver: int) -> int:
+    """
+    Sum someone's karma on the writer, for keeping the cache right
+    """
+    rows = sql.query(f"SELECT {_score('t')} FROM karma_totals t WHERE receiver=?", receiver)
+    return rows[0][0] if rows else 0
+
+def karma_changed(receiver: int, kind: Kind, delta: int):
+    """
+    Keep cached karma right after someone's karma changes by `delta`
+    """
+    global _TOP, _GENERATION # pylint: disable=global-statement
+    if not counted(kind):
+        return
+    _GENERATION += 1
 
-@setup.command("karma")
+    now = time.monotonic()
+    cached = _TOTALS.get(receiver)
+    total = None
+    if cached is not None and cached[0] > now:
+        total = cached[1] + delta
+        _TOTALS[receiver] = (cached[0], total)
+    else:
+        _TOTALS.pop(receiver, None)
+
+    if _TOP is None:
+        return
+    if receiver in _TOP.receivers:
+        _TOP = None # their own entry changed
+    elif delta > 0:
+        if total is None:
+            total = _total_now(receiver)
+            _TOTALS[receiver] = (now + CACHE_TTL, total)
+        if len(_TOP.receivers) < TOP_N or total >= _TOP.cutoff:
+            _TOP = None # they might be on the board now
+
+async def total_for(receiver: int) -> int:
+    """
+    Someone's karma, cached
+    """
+    now = time.monotonic()
+    cached = _TOTALS.get(receiver)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    generation = _GENERATION
+    rows = await sql.read(f"SELECT {_score('t')} FROM karma_totals t WHERE receiver=?",
+                          receiver)
+    total = rows[0][0] if rows else 0
+    if generation == _GENERATION:
+        _TOTALS[receiver] = (now + CACHE_TTL, total)
+    return total
+
+async def top_board() -> typing.List[discord.Embed]:
+    """
+    The karma leaderboard, rendered and cached
+    """
+    global _TOP # pylint: disable=global-statement
+    now = time.monotonic()
+    if _TOP is not None and _TOP.expiry > now:
+        return _TOP.pages
+
+    generation = _GENERATION
+    top = await sql.read(f"""
+        SELECT receiver, {_score('t')} FROM karma_totals t
+        ORDER BY {_score('t')} DESC
+        LIMIT {TOP_N}
+        """)
+    fields = []
+    for idx, row in enumerate(top):
+        user = await resolver.fetch_user_maybe(row[0])
+        if not user:
+            user = f"<user id {row[0]}>"
+        fields.append((f"{idx+1}. {user}", f"{row[1]}$", True))
+
+    pages = embeds.pack("Top karma", fields=fields)
+    cutoff = top[-1][1] if len(top) == TOP_N else float("-inf")
+    if generation == _GENERATION:
+        _TOP = _Top(now + CACHE_TTL, [row[0] for row in top], cutoff, pages)
+    return pages
+
+#
+# Ranks and breakdowns
+#
+
+# Entries in each list of a breakdown
+BREAKDOWN_N = 5
+
+def _rank(con, receiver: int) -> typing.Tuple[int, int]:
+    rows = con.execute(f"""
+        SELECT {_score('t')}, (
+            SELECT COUNT(*) FROM karma_totals o WHERE {_score('o')} > {_score('t')}
+        ) FROM karma_totals t WHERE receiver=?
+        """, (receiver,)).fetchall()
+    if rows:
+        total, ahead = rows[0]
+    else:
+        total = 0
+        ahead = con.execute(f"""
+            SELECT COUNT(*) FROM karma_totals o WHERE {_score('o')} > 0
+            """).fetchone()[0]
+    return total, ahead + 1
+
+async def rank_of(receiver: int) -> typing.Tuple[int, int]:
+    """
+    Someone's karma and their place on the leaderboard, counting how many are
+    ahead of them on the totals index
+    """
+    async with sql.transact("read") as con:
+        return _rank(con, receiver)
+
+async def breakdown(receiver: int) -> typing.Dict[str, typing.Any]:
+    """
+    Where someone's karma came from: up/downvotes and reactions, the people
+    who gave the most and the messages which got the most
+    """
+    def best(con, table, key):
+        return con.execute(f"""
+            SELECT {key}, {_score('t')} FROM {table} t
+            WHERE receiver=? AND {_score('t')} > 0
+            ORDER BY {_score('t')} DESC
+            LIMIT {BREAKDOWN_N}
+            """, (receiver,)).fetchall()
+
+    # One snapshot, so the parts add up
+    async with sql.transact("read") as con:
+        total, rank = _rank(con, receiver)
+        split = con.execute("""
+            SELECT up, down, anyreact FROM karma_totals WHERE receiver=?
+            """, (receiver,)).fetchall()
+        givers = best(con, "karma_by_giver", "giver")
+        messages = best(con, "karma_by_message", "message")
+    up, down, anyreact = split[0] if split else (0, 0, 0)
+    return {
+        "total": total,
+        "rank": rank,
+        "up": up,
+        "down": down,
+        "anyreact": anyreact if counted(Kind.ANYREACT) else None,
+        "givers": [tuple(row) for row in givers],
+        "messages": [tuple(row) for row in messages],
+    }
+
+@setup.group("karma", invoke_without_command=True)
 async def get_karma(ctx, who: commands.UserConverter = None):
     """
     Get the amount of karma a person has.
@@ -102,50 +466,53 @@ async def get_karma(ctx, who: commands.UserConverter = None):
     if who is None:
         who = ctx.author
 
-    query = """
-        SELECT ifnull(SUM(delta), 0) FROM karma
-        WHERE receiver=?
-        """
+    karma = await total_for(who.id)
+    await ctx.send(f"🔶 {who} is at {karma}$", delete_after=60)
 
-    if "no-anyreact" in config.get("karma"):
-        query = """
-            SELECT ifnull(SUM(delta), 0) FROM karma
-            WHERE receiver=? AND kind != 2
-            """
+@get_karma.command("rank")
+async def get_rank(ctx, who: commands.UserConverter = None):
+    """
+    Get someone's place on the karma leaderboard
+    """
+    if who is None:
+        who = ctx.author
 
-    karma = sql.query(query, who.id)
-    karma = (karma[0][0] or 0) if karma else 0
+    karma, rank = await rank_of(who.id)
+    await ctx.send(f"🔶 {who} is #{rank} with {karma}$", delete_after=60)
 
-    await ctx.send(f"🔶 {who} is at {karma}$", delete_after=60)
+@get_karma.command("breakdown")
+async def get_breakdown(ctx, who: commands.UserConverter = None):
+    """
+    Show where someone's karma came from: votes, top givers and best messages
+    """
+    if who is None:
+        who = ctx.author
+
+    info = await breakdown(who.id)
+    votes = f"{upvote} {info['up']}  {downvote} {info['down']}"
+    if info["anyreact"] is not None:
+        votes += f"  + {info['anyreact']} from other reactions"
+
+    givers = []
+    for giver, count in info["givers"]:
+        user = await resolver.fetch_user_maybe(giver)
+        givers.append(f"{user or f'<user id {giver}>'}: {count}$")
+    messages = [f"{discord.utils.snowflake_time(message):%Y-%m-%d} (id {message}): {count}$"
+                for message, count in info["messages"]]
+
+    pages = embeds.pack(
+        f"Karma for {who}",
+        description=f"**{info['total']}$**, #{info['rank']} on the leaderboard",
+        fields=[
+            ("Votes", votes, False),
+            ("Top givers", "\n".join(givers) or "nobody yet", True),
+            ("Best messages", "\n".join(messages) or "none yet", True),
+        ])
+    await embeds.send(ctx, pages, delete_after=60)
 
 @setup.command("ktop")
 async def leaderboards(ctx):
     """
     Show the people who have the most karma
     """
-
-    query = """
-        SELECT receiver, SUM(delta) AS net FROM karma
-        GROUP BY receiver
-        ORDER BY net DESC
-        LIMIT 10
-        """
-
-    if "no-anyreact" in config.get("karma"):
-        query = """
-            SELECT receiver, SUM(delta) AS net FROM karma
-            WHERE kind != 2
-            GROUP BY receiver
-            ORDER BY net DESC
-            LIMIT 10
-            """
-
-    top = sql.query(query)
-    embed = discord.Embed(title="Top karma")
-    for idx, row in enumerate(top):
-        user = await resolver.fetch_user_maybe(row[0])
-        if not user:
-            user = f"<user id {row[0]}>"
-        embed.add_field(name=f"{idx+1}. {user}", value=f"{row[1]}$")
-
-    await ctx.send(embed=embed, delete_after=60)
+    await embeds.send(ctx, await top_board(), delete_after=60)
@@ -6,6 +6,7 @@ from base import fragment
 
 # pylint: disable=invalid-name
 setup = fragment.Fragment()
+teardown = setup.teardown
 # pylint: enable=invalid-name
 
 COURSE_PREFIX = "https://www.handbook.unsw.edu.au/undergraduate/courses/2020/"
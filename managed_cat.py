@@ -9,15 +9,17 @@ made for specific topics/events.
 import asyncio
 import datetime
 import enum
+import heapq
 import logging
 import re
+import time
 import typing
 import unicodedata
 
 import discord
 from discord.ext import commands
 
-from base import fragment, settings, resolver
+from base import config, embeds, fragment, outbound, settings, resolver, sql
 
 # pylint: disable=invalid-name
 managed_cat = settings.ServerSetting(
@@ -28,7 +30,12 @@ dead_cat = settings.ServerSetting(
         name="dead_cat",
         description="ID of category to move channels when emptied",
         parse=int)
+idle_hours = settings.ServerSetting(
+        name="managed_idle_hours",
+        description="Archive managed channels with no messages for this many hours. 0 to disable",
+        parse=float)
 setup = fragment.Fragment()
+teardown = setup.teardown
 _L = logging.getLogger(__name__)
 # pylint: enable=invalid-name
 
@@ -77,7 +84,7 @@ async def to_managed(ctx: commands.Context, channame: typing.Optional[str]):
             await ctx.send("Channel not managed!", delete_after=10)
             return None
     else:
-        chan = discord.utils.get(ctx.guild.text_channels, name=channame, category_id=catid)
+        chan = find_channel(ctx.guild, catid, channame)
         if chan is None:
             await ctx.send("Channel not found!", delete_after=10)
             return None
@@ -85,28 +92,276 @@ async def to_managed(ctx: commands.Context, channame: typing.Optional[str]):
     return chan
 
 
-def get_member_states(channel: discord.TextChannel):
+def scan_member_states(overwrites: dict) -> typing.Dict[State, typing.Set[int]]:
     """
-    Get the members and their states for a managed channel.
+    Work out the IDs of members in each state from a channel's overwrites.
     """
-    out = {i: [] for i in State if i != State.NONE}
-    for member, overwrite in channel.overwrites.items():
+    out = {i: set() for i in State if i != State.NONE}
+    for member, overwrite in overwrites.items():
         if (not isinstance(member, discord.Member) or
                 member.bot):
             continue
         state = State.from_overwrite(overwrite)
         if state == State.NONE:
             continue
-        out[state].append(member)
+        out[state].add(member.id)
     return out
 
+# guild id -> channel id -> state -> member ids
+_MEMBERSHIP = {}
+
+def index_channel(channel: discord.TextChannel, overwrites: typing.Optional[dict] = None):
+    """
+    (Re)build the membership index entry for a channel
+    """
+    if overwrites is None:
+        overwrites = channel.overwrites
+    states = scan_member_states(overwrites)
+    _MEMBERSHIP.setdefault(channel.guild.id, {})[channel.id] = states
+    return states
+
+def get_member_states(channel: discord.TextChannel) -> typing.Dict[State, typing.Set[int]]:
+    """
+    Get the IDs of members in each state for a managed channel.
+    """
+    try:
+        return _MEMBERSHIP[channel.guild.id][channel.id]
+    except KeyError:
+        return index_channel(channel)
+
+# category id -> channel name -> channel id
+_SLUGS = {}
+# channel id -> (category id, name), for what's in _SLUGS
+_SLUG_OF = {}
+
+def index_category(category: discord.CategoryChannel):
+    """
+    (Re)build the name index for a category
+    """
+    for chanid in _SLUGS.pop(category.id, {}).values():
+        _SLUG_OF.pop(chanid, None)
+    names = _SLUGS[category.id] = {}
+    for channel in category.channels:
+        names[channel.name] = channel.id
+        _SLUG_OF[channel.id] = (category.id, channel.name)
+    return names
+
+def index_slug(channel):
+    """
+    Update the name index for a channel which was created, renamed or moved
+    """
+    unindex_slug(channel.id)
+    names = _SLUGS.get(channel.category_id)
+    if names is not None: # only keep up categories we've already indexed
+        names[channel.name] = channel.id
+        _SLUG_OF[channel.id] = (channel.category_id, channel.name)
+
+def unindex_slug(chanid: int):
+    """
+    Remove a channel from the name index
+    """
+    where = _SLUG_OF.pop(chanid, None)
+    if where is not None:
+        catid, name = where
+        names = _SLUGS.get(catid, {})
+        if names.get(name) == chanid:
+            del names[name]
+
+def find_channel(guild: discord.Guild, catid: int, name: str):
+    """
+    Find a channel in a category by name
+    """
+    names = _SLUGS.get(catid)
+    if names is None:
+        category = guild.get_channel(catid)
+        if category is None:
+            return None
+        names = index_category(category)
+    chanid = names.get(name)
+    return guild.get_channel(chanid) if chanid is not None else None
+
+@setup.listen("on_ready")
+async def rebuild_indexes():
+    """
+    Index all managed channels
+    """
+    _MEMBERSHIP.clear()
+    _SLUGS.clear()
+    _SLUG_OF.clear()
+    for guild in setup.bot.guilds:
+        catid = await settings.get_stored(managed_cat.name, server=guild.id)
+        category = guild.get_channel(catid) if catid else None
+        if category is None:
+            continue
+        index_category(category)
+        for channel in category.channels:
+            index_channel(channel)
+        await load_activity(category.channels)
+    _L.info("indexed %d managed channels",
+            sum(len(channels) for channels in _MEMBERSHIP.values()))
+
+@setup.task
+async def reindex_after_reload():
+    """
+    on_ready doesn't fire again when this is reloaded into a running bot, so
+    index straight away
+    """
+    if setup.bot.is_ready():
+        await rebuild_indexes()
+
+@setup.listen("on_guild_channel_create")
+async def on_channel_create(channel):
+    index_channel(channel)
+    index_slug(channel)
+
+@setup.listen("on_guild_channel_delete")
+async def on_channel_delete(channel):
+    _MEMBERSHIP.get(channel.guild.id, {}).pop(channel.id, None)
+    unindex_slug(channel.id)
+    _SLUGS.pop(channel.id, None) # in case it was a category
+
+
+def all_overwrites(channel: discord.TextChannel) -> typing.Optional[dict]:
+    """
+    A channel's overwrites, like `channel.overwrites`, but keeping those for
+    members who aren't cached (keyed by discord.Object), which that leaves
+    out. None if there are some for roles we don't know.
+    """
+    overwrites = dict(channel.overwrites)
+    raw = getattr(channel, "_overwrites", None)
+    if raw is None or len(raw) == len(overwrites):
+        return overwrites
+    known = {target.id for target in overwrites}
+    for entry in raw:
+        if entry.id in known:
+            continue
+        if entry.type != "member":
+            # channel.edit would send it back as a member
+            return None
+        overwrites[discord.Object(id=entry.id)] = discord.PermissionOverwrite.from_pair(
+            discord.Permissions(entry.allow), discord.Permissions(entry.deny))
+    return overwrites
+
+class OverwriteBatch:
+    """
+    Permission overwrite changes to a single channel, waiting to be applied.
+
+    Changes made while an edit to the same channel is still in flight are
+    collected into one batch, and applied together in a single edit once the
+    earlier one finishes.
+    """
+
+    def __init__(self, channel: discord.TextChannel, previous: typing.Optional[asyncio.Future]):
+        self.channel = channel
+        self.previous = previous
+        self.changes = {}
+        self.reasons = []
+        self.applied = asyncio.get_event_loop().create_future()
+
+    def final(self, overwrites: dict) -> dict:
+        """
+        `overwrites` with these changes made
+        """
+        overwrites = dict(overwrites)
+        # Members who aren't cached are keyed by discord.Object, which never
+        # equals the member, so match targets up by id
+        by_id = {target.id: target for target in overwrites}
+        for target, overwrite in self.changes.items():
+            overwrites.pop(by_id.pop(target.id, target), None)
+            if overwrite is not None:
+                overwrites[target] = overwrite
+                by_id[target.id] = target
+        return overwrites
+
+    async def apply(self):
+        """
+        Wait for any earlier edit, then apply all changes in one edit
+        """
+        if self.previous is not None:
+            await asyncio.wait([self.previous])
+        else:
+            await asyncio.sleep(0) # let changes made at the same time join in
+        chanid = self.channel.id
+        del _OVERWRITE_BATCHES[chanid]
+        _APPLYING_OVERWRITES[chanid] = self.applied
+
+        # The gateway may not have told us about our last edit yet
+        current = _EXPECTED_OVERWRITES.get(chanid)
+        if current is None:
+            current = all_overwrites(self.channel)
+        final = self.final(current) if current is not None else None
+        reason = "; ".join(self.reasons)[:512]
+        _L.debug("applying %d overwrite changes to #%s", len(self.changes), self.channel)
+        try:
+            if final:
+                await self.channel.edit(overwrites=final, reason=reason)
+            else:
+                # discord.py ignores an empty overwrites map, and we can't
+                # replace them all without knowing them all, so make the
+                # changes one at a time instead
+                for target, overwrite in self.changes.items():
+                    await self.channel.set_permissions(target, overwrite=overwrite, reason=reason)
+        except Exception as err: # pylint: disable=broad-except
+            self.applied.set_exception(err)
+        else:
+            if final:
+                _EXPECTED_OVERWRITES[chanid] = final
+            else:
+                _EXPECTED_OVERWRITES.pop(chanid, None)
+                final = self.final(self.channel.overwrites)
+            index_channel(self.channel, final)
+            self.applied.set_result(final)
+        finally:
+            if _APPLYING_OVERWRITES.get(chanid) is self.applied:
+                del _APPLYING_OVERWRITES[chanid]
+
+# channel id -> batch waiting to be applied
+_OVERWRITE_BATCHES = {}
+# channel id -> future for the batch currently being applied
+_APPLYING_OVERWRITES = {}
+# channel id -> overwrites we've set but not yet heard back about
+_EXPECTED_OVERWRITES = {}
+
+async def set_overwrite(
+        channel: discord.TextChannel,
+        target: typing.Union[discord.Member, discord.Role],
+        overwrite: typing.Optional[discord.PermissionOverwrite],
+        *,
+        reason: str
+    ) -> dict:
+    """
+    Change the overwrite for a target on a channel, or remove it if None.
+
+    Concurrent changes to the same channel are coalesced into a single edit.
+    Returns the channel's overwrites after the change was applied.
+    """
+    batch = _OVERWRITE_BATCHES.get(channel.id)
+    if batch is None:
+        batch = OverwriteBatch(channel, _APPLYING_OVERWRITES.get(channel.id))
+        _OVERWRITE_BATCHES[channel.id] = batch
+        asyncio.ensure_future(batch.apply())
+    batch.changes[target] = overwrite
+    batch.reasons.append(reason)
+    # shield so one impatient caller can't cancel everyone else's changes
+    return await asyncio.shield(batch.applied)
+
+@setup.listen("on_guild_channel_update")
+async def on_channel_update(_before, after):
+    """
+    Once the gateway tells us about a channel, its overwrites are up to date
+    """
+    _EXPECTED_OVERWRITES.pop(after.id, None)
+    if after.id in _MEMBERSHIP.get(after.guild.id, {}):
+        index_channel(after)
+    index_slug(after)
 
 async def join_channel(user, channel):
     """
     Join a user to a channel
     """
-    await channel.set_permissions(
-        user, read_messages=True, send_messages=True,
+    await set_overwrite(
+        channel, user,
+        discord.PermissionOverwrite(read_messages=True, send_messages=True),
         reason=f"{user.name} requested to join {channel.name}")
 
     now = datetime.datetime.now()
@@ -124,13 +379,197 @@ async def archive_channel(channel, category):
     Archive a channel into a category
     """
     # TODO ensure that we can actually move the channel into the graveyard
-    for member in channel.overwrites.keys():
-        await channel.set_permissions(member, overwrite=None,
-                                      reason="Kicking everyone out")
+    # Everyone gets kicked out by taking on the graveyard's permissions, in the
+    # same edit as the move so we can't end up half-archived. discord.py
+    # ignores an empty overwrites map, which sync_permissions covers.
+    chanid = channel.id
+    # Take a turn in the overwrite batch layer: let changes already on their
+    # way land first, and make any that come in meanwhile wait and build on
+    # the archived overwrites, so nothing puts back what this takes away
+    while True:
+        batch = _OVERWRITE_BATCHES.get(chanid)
+        earlier = batch.applied if batch is not None else _APPLYING_OVERWRITES.get(chanid)
+        if earlier is None:
+            break
+        await asyncio.wait([earlier])
+    applied = asyncio.get_event_loop().create_future()
+    _APPLYING_OVERWRITES[chanid] = applied
 
     grave_dt = datetime.datetime.utcnow().strftime("%-d%b%y-%H%M%S")
-    await channel.edit(name=f"{channel.name}-{grave_dt}", category=category)
+    overwrites = dict(category.overwrites)
+    try:
+        await channel.edit(name=f"{channel.name}-{grave_dt}", category=category,
+                           overwrites=overwrites, sync_permissions=True,
+                           reason="Archiving channel")
+        _EXPECTED_OVERWRITES[chanid] = overwrites
+    finally:
+        # only used for ordering, so failures are left to our caller
+        applied.set_result(overwrites)
+        if _APPLYING_OVERWRITES.get(chanid) is applied:
+            del _APPLYING_OVERWRITES[chanid]
+
+
+#
+# Idle channel reaper
+#
+
+sql.require_table("managed_activity", """
+        channel INTEGER PRIMARY KEY,
+        last REAL NOT NULL
+        """)
+
+# channel id -> unix time of last message
+_LAST_ACTIVE = {}
+# (deadline, channel id) min-heap of when to next look at a channel
+_DEADLINES = []
+# channels with an entry in _DEADLINES
+_QUEUED = set()
+# channels whose activity hasn't been persisted yet
+_DIRTY = set()
+
+def track_activity(chanid: int, when: float):
+    """
+    Note that a managed channel was active at a given time
+    """
+    if when <= _LAST_ACTIVE.get(chanid, 0):
+        return
+    _LAST_ACTIVE[chanid] = when
+    _DIRTY.add(chanid)
+    if chanid not in _QUEUED:
+        # the next sweep works out the real deadline
+        heapq.heappush(_DEADLINES, (when, chanid))
+        _QUEUED.add(chanid)
+
+def untrack_activity(chanid: int):
+    """
+    Stop tracking a channel. Its heap entry is dropped when it comes up.
+    """
+    _LAST_ACTIVE.pop(chanid, None)
+    _DIRTY.add(chanid)
+
+async def load_activity(channels: typing.Iterable[discord.TextChannel]):
+    """
+    Start tracking channels, from persisted activity or their last message,
+    whichever is later (activity may not have been persisted yet)
+    """
+    stored = dict(await sql.read("SELECT channel, last FROM managed_activity"))
+    for channel in channels:
+        last_id = getattr(channel, "last_message_id", None) or channel.id
+        last = discord.utils.snowflake_time(last_id).replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+        track_activity(channel.id, max(last, stored.get(channel.id, last)))
+    _DIRTY.difference_update([chanid for chanid, last in stored.items()
+                              if _LAST_ACTIVE.get(chanid) == last])
+
+@setup.listen("teardown")
+async def persist_activity():
+    """
+    Write out activity which changed since last time
+    """
+    if not _DIRTY:
+        return
+    rows = [(chanid, _LAST_ACTIVE.get(chanid)) for chanid in _DIRTY]
+    async with sql.transact() as con:
+        con.executemany("""
+            INSERT OR REPLACE INTO managed_activity(channel, last) VALUES (?, ?)
+            """, [row for row in rows if row[1] is not None])
+        con.executemany("""
+            DELETE FROM managed_activity WHERE channel=?
+            """, [row[:1] for row in rows if row[1] is None])
+    _L.debug("persisted activity for %d channels", len(rows))
+    _DIRTY.clear()
+
+@setup.listen("on_message")
+async def on_managed_message(message):
+    if message.channel.id in _SLUG_OF:
+        track_activity(message.channel.id, time.time())
+
+async def reap_idle(now: float):
+    """
+    Archive managed channels which have been idle for too long.
+
+    This only looks at channels whose deadline has passed, and archives at
+    most `managed_cat.archive_budget` channels per guild.
+    """
+    idle_cache = {}
+    spent = {}
+    deferred = []
+    budget = config.get("managed_cat.archive_budget")
+
+    while _DEADLINES and _DEADLINES[0][0] <= now:
+        _, chanid = heapq.heappop(_DEADLINES)
+        _QUEUED.discard(chanid)
+        last = _LAST_ACTIVE.get(chanid)
+        channel = setup.bot.get_channel(chanid)
+        if last is None or channel is None or chanid not in _SLUG_OF:
+            untrack_activity(chanid) # gone, or no longer managed
+            continue
 
+        guild = channel.guild
+        if guild.id not in idle_cache:
+            idle_cache[guild.id] = await settings.get_stored(idle_hours.name, server=guild.id)
+        idle = idle_cache[guild.id]
+        if not idle:
+            continue # disabled; requeue_on_setting picks it up again
+
+        deadline = last + idle * 60 * 60
+        if deadline > now:
+            deferred.append((deadline, chanid))
+            continue
+
+        if spent.get(guild.id, 0) >= budget:
+            deferred.append((now, chanid)) # try again next sweep
+            continue
+
+        graveyard = guild.get_channel(await settings.get_stored(dead_cat.name, server=guild.id))
+        if graveyard is None:
+            continue # nowhere to put it, until dead_cat is set
+        spent[guild.id] = spent.get(guild.id, 0) + 1
+        _L.info("archiving #%s, idle since %s", channel, datetime.datetime.fromtimestamp(last))
+        untrack_activity(chanid)
+        try:
+            await outbound.call(("channels", guild.id),
+                                lambda: archive_channel(channel, graveyard))
+        except discord.HTTPException as err:
+            _L.warning("failed to archive idle #%s: %s", channel, err)
+
+    for entry in deferred:
+        heapq.heappush(_DEADLINES, entry)
+        _QUEUED.add(entry[1])
+
+@settings.watch
+def requeue_on_setting(option, server, channel, user):
+    """
+    Sweeps drop channels from the heap while reaping is disabled or there's
+    no graveyard, so put them back when either setting changes
+    """
+    # pylint: disable=unused-argument
+    if option not in (idle_hours.name, dead_cat.name) or setup.bot is None:
+        return
+    for chanid, last in _LAST_ACTIVE.items():
+        if chanid in _QUEUED:
+            continue
+        chan = setup.bot.get_channel(chanid)
+        if chan is not None and server in (-1, chan.guild.id):
+            heapq.heappush(_DEADLINES, (last, chanid))
+            _QUEUED.add(chanid)
+
+@setup.task
+async def idle_reaper():
+    """
+    Periodically archive idle channels, and persist activity
+    """
+    await setup.bot.wait_until_ready()
+    while True:
+        await asyncio.sleep(config.get("managed_cat.sweep_minutes") * 60)
+        try:
+            await reap_idle(time.time())
+        except Exception: # pylint: disable=broad-except
+            _L.exception("failed to archive idle channels")
+        try:
+            await persist_activity()
+        except Exception: # pylint: disable=broad-except
+            _L.exception("failed to persist activity")
 
 @setup.command("clear")
 @commands.check(fragment.is_admin_or_owner)
@@ -162,25 +601,44 @@ async def list_channels(ctx):
     if not catid:
         return
 
-    embed = discord.Embed(title="Available channels")
-
     channels = ctx.guild.get_channel(catid).channels
-    if channels:
-        embed.description = f"{len(channels)} channels"
-    else:
-        embed.description = "No channels yet"
+    # One line per channel packs far more in than one field per channel
+    lines = [f"{len(channels)} channels" if channels else "No channels yet", ""]
+    lines += [
+        f"**{channel.name}**: {len(get_member_states(channel)[State.ACTIVE])} users"
+        for channel in channels
+    ]
+    pages = embeds.pack("Available channels", description="\n".join(lines))
+    await embeds.send(ctx, pages, paginate=True)
 
-    for channel in channels:
-        # HACK hardcoding the max number of fields in an embed
-        if len(embed.fields) > 25:
-            await ctx.send(embed=embed)
-            embed = discord.Embed(title="Available channels")
-        mstates = get_member_states(channel)
-        active = len(mstates[State.ACTIVE])
-        embed.add_field(name=channel.name, value=f"{active} users")
 
-    await ctx.send(embed=embed)
+# (guild id, name) -> task creating that channel
+_CREATING = {}
 
+async def create_channel(ctx: commands.Context, cat: discord.CategoryChannel, channame: str):
+    """
+    Create a managed channel. If it's already being created, wait for that
+    instead of making a duplicate.
+    """
+    key = (ctx.guild.id, channame)
+    task = _CREATING.get(key)
+    if task is None:
+        async def create():
+            overwrites = {
+                ctx.guild.default_role: discord.PermissionOverwrite(read_messages=False),
+                ctx.guild.me: discord.PermissionOverwrite(read_messages=True),
+            }
+            chan = await ctx.guild.create_text_channel(
+                channame, overwrites=overwrites, category=cat,
+                reason=f"{ctx.author.name} requested to join {channame}")
+            # don't wait for the gateway before others can find it
+            index_channel(chan)
+            index_slug(chan)
+            return chan
+
+        task = _CREATING[key] = asyncio.ensure_future(create())
+        task.add_done_callback(lambda _: _CREATING.pop(key, None))
+    return await asyncio.shield(task)
 
 @setup.command()
 @commands.check(is_managed)
@@ -198,24 +656,17 @@ async def join(ctx, *, channame: slugify = None):
         if chan.category_id != catid:
             await ctx.send("No channel specified, and current is not managed", delete_after=10)
             return
-        if ctx.author in get_member_states(chan)[State.ACTIVE]:
+        if ctx.author.id in get_member_states(chan)[State.ACTIVE]:
             await ctx.send("Already in this channel", delete_after=10)
             return
     elif not channame:
         await ctx.send("Invalid channel name", delete_after=10)
         return
     else:
-        chan = discord.utils.get(cat.channels, name=channame)
+        chan = find_channel(ctx.guild, catid, channame)
 
     if chan is None:
-        # create it
-        overwrites = {
-            ctx.guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            ctx.guild.me: discord.PermissionOverwrite(read_messages=True),
-        }
-        chan = await ctx.guild.create_text_channel(
-            channame, overwrites=overwrites, category=cat,
-            reason=f"{ctx.author.name} requested to join {channame}")
+        chan = await create_channel(ctx, cat, channame)
 
     embed = await join_channel(ctx.author, chan)
     await chan.send(embed=embed)
@@ -235,14 +686,15 @@ async def view(ctx, *, channame: slugify = None):
 
     active = get_member_states(chan)[State.ACTIVE]
 
-    if len(active) == 1 and active[0].id == ctx.author.id:
+    if active == {ctx.author.id}:
         await ctx.send("\u200b:exclamation: You're the only one left. "
                        "Leave if you want to delete this channel.",
                        delete_after=60)
         return
 
-    await chan.set_permissions(
-        ctx.author, read_messages=True, send_messages=False,
+    await set_overwrite(
+        chan, ctx.author,
+        discord.PermissionOverwrite(read_messages=True, send_messages=False),
         reason=f"{ctx.author.name} requested to only view {chan.name}")
 
 @setup.command()
@@ -270,13 +722,12 @@ async def leave(ctx, *, channame: slugify = None):
     if chan is None:
         return
 
-    await chan.set_permissions(ctx.author, overwrite=None,
-                               reason=f"{ctx.author.name} requested to leave {chan.name}")
-
-    # HACK to avoid 0-member channels
-    await asyncio.sleep(0.5)
+    # Decide from the overwrites we just applied rather than waiting for the
+    # gateway to catch up
+    final = await set_overwrite(chan, ctx.author, None,
+                                reason=f"{ctx.author.name} requested to leave {chan.name}")
 
-    if not get_member_states(chan)[State.ACTIVE]: # everyone left
+    if not scan_member_states(final)[State.ACTIVE]: # everyone left
         graveyard = ctx.guild.get_channel(await dead_cat.get(ctx))
         if graveyard is not None:
             # TODO handle this failing
@@ -292,11 +743,14 @@ async def whosin(ctx, *, channame: slugify = None):
     if chan is None:
         return
 
-    embed = discord.Embed(title="People in {}".format(chan.name))
-
-    members = get_member_states(chan)
-    embed.description = "\n".join(m.display_name for m in members[State.ACTIVE])
-    embed.description += "\n"
-    embed.description += "\n".join(f"[_viewing_] {m.display_name}" for m in members[State.PASSIVE])
-
-    await ctx.send(embed=embed)
+    states = get_member_states(chan)
+    members = {
+        state: filter(None, map(ctx.guild.get_member, ids))
+        for state, ids in states.items()
+    }
+    description = "\n".join(m.display_name for m in members[State.ACTIVE])
+    description += "\n"
+    description += "\n".join(f"[_viewing_] {m.display_name}" for m in members[State.PASSIVE])
+
+    await embeds.send(ctx, embeds.pack(f"People in {chan.name}", description=description),
+                      paginate=True)
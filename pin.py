@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
+import asyncio
+import collections
 import logging
+import typing
 
 import discord
 from discord.ext import commands
 
-from base import fragment, settings, resolver
+from base import fragment, outbound, settings, resolver, sql
 
 setup = fragment.Fragment()
+teardown = setup.teardown
 _L = logging.getLogger(__name__)
 
 STAR = '\u2b50'
@@ -20,28 +24,246 @@ pin_threshhold = settings.ServerChannelSetting(
         name="pin_threshhold",
         description="Minimum number of \u2b50 to pin message",
         parse=int)
+pin_unpin = settings.ServerChannelSetting(
+        name="pin_unpin",
+        description="Remove pinned messages which drop below the \u2b50 threshhold",
+        parse=settings.true_false,
+        default=False)
 
-@setup.listen("on_raw_reaction_add")
-async def on_maybe_star(payload: discord.RawReactionActionEvent):
+# How long to wait for more stars before updating a pinned message's count
+UPDATE_DELAY = 10
+# How long to collect stars on an unpinned message before checking it
+STAR_DEBOUNCE = 1
+# Unpinned messages with recent stars that we keep counts for
+_CANDIDATE_CACHE_SIZE = 512
+# Pinboard messages we've sent or fetched, so updates don't need a fetch
+_PIN_CACHE_SIZE = 256
+
+sql.require_table("pinboard", """
+        message INTEGER PRIMARY KEY,
+        channel INTEGER NOT NULL,
+        pin_channel INTEGER,
+        pin_message INTEGER,
+        stars INTEGER NOT NULL
+        """)
+
+# Stars on a message are counted one event at a time, in order
+stars = fragment.Dispatch("pin", workers=8, limit=500,
+                          key=lambda payload: payload.message_id)
+
+# source message id -> pending count update
+_UPDATES: typing.Dict[int, asyncio.Future] = {}
+# pinboard message id -> message
+_PIN_MESSAGES: typing.Dict[int, discord.Message] = collections.OrderedDict()
+
+class Candidate:
     """
-    Possibly star a message
+    An unpinned message that's been getting stars.
+
+    The message is fetched (and its stars counted) once, the first time it's
+    checked. After that, the count is kept up to date from reaction events.
+
+    Events around a fetch may or may not be in the count it gives, so while
+    fetching, new stars are added on top and removals are ignored, which can
+    only make the count too high. So can a removal dropped by a full `stars`
+    queue, while a dropped star makes it too low. So the message is fetched
+    again to make sure before it's pinned, or if it's short of the threshold
+    but events have been dropped since it was last fetched. (A dropped star
+    with no events after it waits for reconcile.)
     """
 
-    channel = await resolver.fetch_channel_maybe(payload.channel_id)
-    if not channel:
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.message: typing.Optional[discord.Message] = None
+        self.count: typing.Optional[int] = None
+        # Held while checking, so only one check can pin the message
+        self.lock = asyncio.Lock()
+        self.checking: typing.Optional[asyncio.Future] = None
+        self.fetching = False
+        # Stars which came in while fetching
+        self.missed = 0
+        # stars.dropped as of the last fetch
+        self.dropped = 0
+
+# source message id -> candidate
+_CANDIDATES: typing.Dict[int, Candidate] = collections.OrderedDict()
+
+def remember_pin(message: discord.Message):
+    _PIN_MESSAGES[message.id] = message
+    _PIN_MESSAGES.move_to_end(message.id)
+    while len(_PIN_MESSAGES) > _PIN_CACHE_SIZE:
+        _PIN_MESSAGES.popitem(last=False)
+
+async def get_pinned(message_id: int) -> typing.Optional[dict]:
+    """
+    The pinboard entry for a message, if it's been pinned
+    """
+    rows = await sql.read("SELECT * FROM pinboard WHERE message=?", message_id)
+    return dict(rows[0]) if rows else None
+
+def pin_embed(message: discord.Message, count: int) -> discord.Embed:
+    """
+    The pinboard embed for a message
+    """
+    embed = discord.Embed(title=f":star: {count}", color=0xf8aa39, url=message.jump_url)
+    embed.description = message.clean_content
+    embed.set_footer(text=f"#{message.channel}")
+    embed.set_author(name=message.author.display_name,
+                     icon_url=message.author.avatar_url_as(format="png", size=64))
+    embed.timestamp = message.created_at
+
+    if message.attachments:
+        field = "\n".join(f"[{att.filename}]({att.proxy_url})" for att in message.attachments)
+        embed.add_field(name="Attachments", value=field, inline=False)
+
+        if message.attachments[0].filename.endswith((".png", ".jpg", ".jpeg")):
+            embed.set_image(url=message.attachments[0].proxy_url)
+
+    return embed
+
+def schedule_update(message_id: int):
+    """
+    Update a pinned message's pinboard post once stars stop coming in for a
+    while
+    """
+    if message_id not in _UPDATES:
+        _UPDATES[message_id] = setup.spawn(update_later(message_id))
+
+def count_star(entry: dict, delta: int):
+    """
+    Count a star on an already pinned message
+    """
+    sql.query("UPDATE pinboard SET stars=stars+? WHERE message=?", delta, entry["message"])
+    schedule_update(entry["message"])
+
+async def update_later(message_id: int):
+    """
+    Bring a pinboard post's count up to date, or remove it if it's dropped
+    below the threshhold and that's enabled.
+
+    This recounts from the message itself, so the stored count can't drift
+    for long.
+    """
+    try:
+        await asyncio.sleep(UPDATE_DELAY)
+    finally:
+        del _UPDATES[message_id]
+
+    entry = await get_pinned(message_id)
+    if entry is None or entry["pin_message"] is None:
+        return # gone, or pinned before we kept track
+    source = setup.bot.get_channel(entry["channel"])
+    pin_chan = setup.bot.get_channel(entry["pin_channel"])
+    if source is None or pin_chan is None:
+        return
+    message = await resolver.fetch_message_maybe(source, message_id)
+    if message is None:
         return
-    message = await resolver.fetch_message_maybe(channel, payload.message_id)
-    if not message:
+    star = discord.utils.get(message.reactions, emoji=STAR)
+    count = star.count if star else 0
+    sql.query("UPDATE pinboard SET stars=? WHERE message=?", count, message_id)
+
+    pinned = _PIN_MESSAGES.get(entry["pin_message"])
+    if pinned is None:
+        pinned = await resolver.fetch_message_maybe(pin_chan, entry["pin_message"])
+        if pinned is None:
+            return
+        remember_pin(pinned)
+
+    if await pin_unpin.get(source) and count < await pin_threshhold.get(source):
+        _L.debug("pin: unpinning message=%s", message_id)
+        sql.query("DELETE FROM pinboard WHERE message=?", message_id)
+        _PIN_MESSAGES.pop(pinned.id, None)
+        await outbound.call(("messages", pin_chan.id), pinned.delete,
+                            priority=outbound.Priority.PINBOARD)
+        return
+
+    if not pinned.embeds:
         return
+    embed = pinned.embeds[0].copy()
+    embed.title = f":star: {count}"
+    await outbound.edit(pinned, embed=embed, priority=outbound.Priority.PINBOARD)
 
+def get_candidate(message_id: int, channel_id: int) -> Candidate:
+    """
+    Find or start tracking an unpinned message
+    """
+    cand = _CANDIDATES.get(message_id)
+    if cand is None:
+        cand = _CANDIDATES[message_id] = Candidate(channel_id)
+        # Forget the oldest, as long as nothing's happening with them
+        for mid in list(_CANDIDATES)[:max(0, len(_CANDIDATES) - _CANDIDATE_CACHE_SIZE)]:
+            old = _CANDIDATES[mid]
+            if old.checking is None and not old.lock.locked():
+                del _CANDIDATES[mid]
+    _CANDIDATES.move_to_end(message_id)
+    return cand
+
+async def check_later(message_id: int, cand: Candidate):
+    """
+    Check a candidate once stars have stopped coming in for a moment
+    """
+    await asyncio.sleep(STAR_DEBOUNCE)
+    # Stars from now on need another check, which waits for this one
+    cand.checking = None
+    async with cand.lock:
+        await check_candidate(message_id, cand)
+
+def adopt(cand: Candidate, message: discord.Message) -> bool:
+    """
+    Take the count from a freshly fetched message. Returns False if it turns
+    out to already be pinned.
+    """
     star = discord.utils.get(message.reactions, emoji=STAR)
+    cand.message = message
+    cand.count = star.count if star else 0
+
+    if star and star.me:
+        # Pinned before the pinboard table, when we marked pins by starring
+        sql.query("""
+            INSERT OR IGNORE INTO pinboard(message, channel, stars)
+            VALUES (?, ?, ?)
+            """, message.id, message.channel.id, star.count)
+        return False
+    return True
+
+async def fetch_candidate(message_id: int, cand: Candidate) -> typing.Optional[int]:
+    """
+    (Re)fetch a candidate, returning its star count from the message itself.
+    None if it's gone or turns out to already be pinned.
+    """
+    cand.fetching = True
+    cand.missed = 0
+    cand.dropped = stars.dropped
+    try:
+        channel = await resolver.fetch_channel_maybe(cand.channel_id)
+        message = channel and await resolver.fetch_message_maybe(channel, message_id)
+    finally:
+        cand.fetching = False
+    if not message or not adopt(cand, message):
+        return None
+    fetched = cand.count
+    cand.count += cand.missed
+    return fetched
+
+async def check_candidate(message_id: int, cand: Candidate, fetched: typing.Optional[int] = None):
+    """
+    Pin a message if it has enough stars. `fetched` is its count from the
+    message itself, if it's just been fetched.
+    """
+    if await get_pinned(message_id) is not None:
+        _CANDIDATES.pop(message_id, None)
+        return
+
+    if cand.message is None:
+        fetched = await fetch_candidate(message_id, cand)
+        if fetched is None:
+            _CANDIDATES.pop(message_id, None)
+            return
 
-    if (not star # no stars
-            or payload.emoji.name != STAR # not star
-            or star.me # we've starred this
-            or (not message.clean_content and not message.attachments) # empty
-       ):
-        _L.debug("pin: message=%s does not satisfy requirements", message.id)
+    message = cand.message
+    if not message.clean_content and not message.attachments:
+        _L.debug("pin: message=%s is empty", message.id)
         return
 
     sb_id = await pin_channel.get(message)
@@ -49,9 +271,19 @@ async def on_maybe_star(payload: discord.RawReactionActionEvent):
     if not sb_id:
         _L.debug("pin: message=%s not configured", message.id)
         return
-    if star.count < sb_threshhold:
+    if cand.count < sb_threshhold and (fetched is not None or stars.dropped == cand.dropped):
         _L.debug("pin: message=%s not enough stars", message.id)
         return
+    if fetched is None:
+        # The count from events may be off
+        fetched = await fetch_candidate(message_id, cand)
+        if fetched is None:
+            _CANDIDATES.pop(message_id, None)
+            return
+        message = cand.message
+    if fetched < sb_threshhold:
+        _L.debug("pin: message=%s not enough stars after all", message.id)
+        return
     sb_channel = await resolver.fetch_channel_maybe(sb_id)
     if not sb_channel:
         _L.warn("pin: pin_channel=%s does not exist", sb_id)
@@ -59,21 +291,84 @@ async def on_maybe_star(payload: discord.RawReactionActionEvent):
 
     _L.debug("pin: pinning message=%s into channel=%s", message.id, sb_id)
 
-    # we've definitely starring at this point
-    await message.add_reaction(STAR)
+    # Claim it first, so it's only ever pinned once
+    sql.query("""
+        INSERT INTO pinboard(message, channel, pin_channel, stars)
+        VALUES (?, ?, ?, ?)
+        """, message.id, message.channel.id, sb_channel.id, fetched)
+    try:
+        pinned = await outbound.send(sb_channel, embed=pin_embed(message, fetched),
+                                     priority=outbound.Priority.PINBOARD)
+    except:
+        sql.query("DELETE FROM pinboard WHERE message=?", message.id)
+        raise
+    sql.query("UPDATE pinboard SET pin_message=? WHERE message=?", pinned.id, message.id)
+    remember_pin(pinned)
+    _CANDIDATES.pop(message_id, None)
 
-    embed = discord.Embed(title=":star:", color=0xf8aa39, url=message.jump_url)
-    embed.description = message.clean_content
-    embed.set_footer(text=f"#{channel}")
-    embed.set_author(name=message.author.display_name,
-                     icon_url=message.author.avatar_url_as(format="png", size=64))
-    embed.timestamp = message.created_at
+@setup.listen("on_raw_reaction_add", dispatch=stars)
+async def on_maybe_star(payload: discord.RawReactionActionEvent):
+    """
+    Possibly star a message
+    """
+    if payload.emoji.name != STAR:
+        return
 
-    if message.attachments:
-        field = "\n".join(f"[{att.filename}]({att.proxy_url})" for att in message.attachments)
-        embed.add_field(name="Attachments", value=field, inline=False)
+    entry = await get_pinned(payload.message_id)
+    if entry is not None:
+        count_star(entry, +1)
+        return
 
-        if message.attachments[0].filename.endswith((".png", ".jpg", ".jpeg")):
-            embed.set_image(url=message.attachments[0].proxy_url)
+    cand = get_candidate(payload.message_id, payload.channel_id)
+    if cand.fetching:
+        cand.missed += 1
+    elif cand.count is not None:
+        cand.count += 1
+    if cand.checking is None:
+        cand.checking = setup.spawn(check_later(payload.message_id, cand))
+
+@setup.listen("on_raw_reaction_remove", dispatch=stars)
+async def on_maybe_unstar(payload: discord.RawReactionActionEvent):
+    """
+    Keep star counts up to date
+    """
+    if payload.emoji.name != STAR:
+        return
+
+    entry = await get_pinned(payload.message_id)
+    if entry is not None:
+        count_star(entry, -1)
+        return
+
+    cand = _CANDIDATES.get(payload.message_id)
+    if cand is not None and cand.count is not None and not cand.fetching:
+        cand.count -= 1
+
+async def reconcile(messages: typing.List[discord.Message]):
+    """
+    Catch up on stars given while we weren't listening, from freshly fetched
+    messages
+    """
+    if not messages:
+        return
+    rows = await sql.read(f"""
+        SELECT message, stars FROM pinboard
+        WHERE message IN ({", ".join("?" * len(messages))})
+        """, *[message.id for message in messages])
+    stored = {row[0]: row[1] for row in rows}
 
-    await sb_channel.send(embed=embed)
+    for message in messages:
+        star = discord.utils.get(message.reactions, emoji=STAR)
+        count = star.count if star else 0
+        if message.id in stored:
+            if stored[message.id] != count:
+                sql.query("UPDATE pinboard SET stars=? WHERE message=?", count, message.id)
+                schedule_update(message.id)
+        elif count:
+            cand = get_candidate(message.id, message.channel.id)
+            async with cand.lock:
+                cand.dropped = stars.dropped
+                if adopt(cand, message):
+                    await check_candidate(message.id, cand, count)
+                else:
+                    _CANDIDATES.pop(message.id, None)
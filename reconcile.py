@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Catch up on reactions given while the bot wasn't listening.
+
+After each (re)connect, recent history in channels with karma or a pinboard
+is paged through, and up/downvotes and star counts are brought in line with
+the reactions actually on each message. Progress is checkpointed per channel
+with each page, and each run has a budget of REST calls. A run that runs out
+carries on from its checkpoints after a pause.
+"""
+
+import asyncio
+import datetime
+import logging
+import typing
+
+import discord
+
+from base import config, fragment, sql
+import karma
+import pin
+
+setup = fragment.Fragment()
+teardown = setup.teardown
+_L = logging.getLogger(__name__)
+
+# Messages per history request
+PAGE = 100
+
+sql.require_table("reconcile_checkpoint", """
+        channel INTEGER PRIMARY KEY,
+        until INTEGER NOT NULL,
+        last INTEGER NOT NULL
+        """)
+
+class OutOfBudget(Exception):
+    pass
+
+class Budget:
+    """
+    A number of REST calls a run may make
+    """
+
+    def __init__(self, calls: int):
+        self.left = calls
+
+    def spend(self, calls: int = 1):
+        """
+        Use up some calls, raising OutOfBudget if there aren't enough left
+        """
+        if calls > self.left:
+            raise OutOfBudget()
+        self.left -= calls
+
+async def wanted(channel: discord.TextChannel) -> typing.Tuple[bool, bool]:
+    """
+    Whether karma and pinning are on in a channel
+    """
+    return bool(await karma.enable.get(channel)), bool(await pin.pin_channel.get(channel))
+
+async def start_of(channel: discord.TextChannel, until: int, lookback: int) -> int:
+    """
+    The message id to start scanning a channel after
+    """
+    start = until - lookback
+    rows = await sql.read("SELECT until, last FROM reconcile_checkpoint WHERE channel=?",
+                          channel.id)
+    if rows:
+        prev_until, last = rows[0]
+        if prev_until == until:
+            start = last # resuming this run
+        elif last < prev_until:
+            start = min(start, last) # an earlier run didn't finish
+    return start
+
+async def reconcile_page(
+        channel: discord.TextChannel,
+        messages: typing.List[discord.Message],
+        until: int,
+        do_karma: bool,
+        do_pin: bool,
+        budget: Budget,
+        fetches: asyncio.Semaphore
+    ):
+    """
+    Fix up one page of messages, and checkpoint past it
+    """
+    voted = []
+    if do_karma:
+        async def fetch(message):
+            async with fetches:
+                return message, await karma.votes_on(message)
+        todo = []
+        for message in messages:
+            reactions = karma.vote_reactions(message)
+            budget.spend(sum(-(-reaction.count // PAGE) for reaction in reactions))
+            if reactions:
+                todo.append(fetch(message))
+            else:
+                voted.append((message, set()))
+        voted += await asyncio.gather(*todo)
+
+    async with sql.transact() as con:
+        changes = karma.apply_votes(con, voted)
+        con.execute("""
+            INSERT OR REPLACE INTO reconcile_checkpoint(channel, until, last)
+            VALUES (?, ?, ?)
+            """, (channel.id, until, messages[-1].id))
+    for change in changes:
+        karma.karma_changed(*change)
+
+    if do_pin:
+        await pin.reconcile(messages)
+
+async def reconcile_channel(
+        channel: discord.TextChannel,
+        until: int,
+        budget: Budget,
+        fetches: asyncio.Semaphore
+    ):
+    """
+    Scan a channel's history up to `until`
+    """
+    do_karma, do_pin = await wanted(channel)
+    if not do_karma and not do_pin:
+        return
+    # milliseconds are above the low 22 bits of a snowflake
+    lookback = int(config.get("reconcile.lookback_hours") * 60 * 60 * 1000) << 22
+    start = await start_of(channel, until, lookback)
+
+    page = []
+    budget.spend()
+    async for message in channel.history(limit=None, after=discord.Object(start),
+                                         before=discord.Object(until), oldest_first=True):
+        page.append(message)
+        if len(page) == PAGE:
+            await reconcile_page(channel, page, until, do_karma, do_pin, budget, fetches)
+            page = []
+            budget.spend() # the next page
+    if page:
+        await reconcile_page(channel, page, until, do_karma, do_pin, budget, fetches)
+
+    sql.query("""
+        INSERT OR REPLACE INTO reconcile_checkpoint(channel, until, last)
+        VALUES (?, ?, ?)
+        """, channel.id, until, until)
+
+async def reconcile_all(until: int, budget: Budget) -> bool:
+    """
+    Scan every channel up to `until`. Returns whether everything was done
+    within budget.
+    """
+    channels = asyncio.Semaphore(config.get("reconcile.channels"))
+    fetches = asyncio.Semaphore(config.get("reconcile.fetches"))
+    finished = True
+
+    async def one(channel):
+        nonlocal finished
+        async with channels:
+            try:
+                await reconcile_channel(channel, until, budget, fetches)
+            except OutOfBudget:
+                finished = False
+            except discord.Forbidden:
+                _L.debug("reconcile: can't read history in #%s", channel)
+
+    await asyncio.gather(*[one(channel)
+                           for guild in setup.bot.guilds
+                           for channel in guild.text_channels])
+    return finished
+
+# Set when we (re)connect, as there may be reactions we missed
+_WAKE: typing.Optional[asyncio.Event] = None
+
+@setup.listen("on_ready")
+async def wake_reconciler():
+    if _WAKE is not None:
+        _WAKE.set()
+
+async def run(until: int) -> bool:
+    """
+    One go at reconciling up to `until`, within a budget
+    """
+    budget = Budget(config.get("reconcile.rest_budget"))
+    started = datetime.datetime.utcnow()
+    try:
+        finished = await reconcile_all(until, budget)
+    except Exception: # pylint: disable=broad-except
+        _L.exception("reconcile: run failed")
+        finished = False
+    _L.info("reconcile: %s in %s, %d REST calls to spare",
+            "finished" if finished else "paused",
+            datetime.datetime.utcnow() - started, budget.left)
+    return finished
+
+@setup.task
+async def reconciler():
+    """
+    Reconcile after each connect, pausing whenever the budget runs out
+    """
+    global _WAKE # pylint: disable=global-statement
+    _WAKE = asyncio.Event()
+    while True:
+        await _WAKE.wait()
+        _WAKE.clear()
+        until = discord.utils.time_snowflake(datetime.datetime.utcnow())
+        while not await run(until):
+            try:
+                await asyncio.wait_for(_WAKE.wait(), config.get("reconcile.pause_minutes") * 60)
+                break # reconnected since, so start over from then
+            except asyncio.TimeoutError:
+                pass # carry on with this run
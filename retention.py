@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Keep the database small.
+
+Votes on old messages are moved out of the karma table into compressed,
+append-only archive files, and stay counted in karma's aggregates. The space
+this frees is given back to the filesystem a little at a time with
+incremental vacuum, and the query planner's statistics are kept up to date
+with `PRAGMA optimize`.
+
+All of this waits for a quiet period (no events for a while), and each step
+stops as soon as things pick up again.
+
+Archives are gzipped JSON lines, one row per line, named after the table and
+the month of the message. Each batch is appended as its own gzip member, so
+they can be read back with e.g. `zcat` or `base.recorder.read`.
+"""
+
+import asyncio
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import pathlib
+import time
+import typing
+
+import discord
+
+from base import config, fragment, sql
+import karma
+
+setup = fragment.Fragment()
+teardown = setup.teardown
+_L = logging.getLogger(__name__)
+
+# Tables with rows to archive: table -> (snowflake column, max age config key,
+# called with the cutoff before archiving)
+ARCHIVED = {
+    "karma": ("message", "retention.karma_days", karma.fold),
+}
+
+#
+# Quiet periods
+#
+
+_LAST_ACTIVITY = time.monotonic()
+
+@setup.listen("on_message")
+@setup.listen("on_raw_reaction_add")
+@setup.listen("on_raw_reaction_remove")
+async def mark_active(*_args):
+    global _LAST_ACTIVITY # pylint: disable=global-statement
+    _LAST_ACTIVITY = time.monotonic()
+
+def quiet() -> bool:
+    """
+    Whether there's been no activity for long enough to do maintenance
+    """
+    return time.monotonic() - _LAST_ACTIVITY >= config.get("retention.quiet_seconds")
+
+async def until_quiet():
+    """
+    Wait for a quiet period
+    """
+    while not quiet():
+        idle = time.monotonic() - _LAST_ACTIVITY
+        await asyncio.sleep(max(1, config.get("retention.quiet_seconds") - idle))
+
+#
+# Archiving
+#
+
+def archive_file(table: str, snowflake: int) -> pathlib.Path:
+    """
+    The archive a row goes in
+    """
+    month = discord.utils.snowflake_time(snowflake)
+    return pathlib.Path(config.get("retention.archive_path")) / f"{table}-{month:%Y-%m}.jsonl.gz"
+
+def append_archive(table: str, column: str, rows: typing.List[dict]):
+    """
+    Append rows to their archives, making sure they're on disk
+    """
+    by_file = collections.defaultdict(list)
+    for row in rows:
+        by_file[archive_file(table, row[column])].append(row)
+
+    for path, part in by_file.items():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        lines = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in part)
+        with open(path, "ab") as archive:
+            archive.write(gzip.compress(lines.encode()))
+            archive.flush()
+            os.fsync(archive.fileno())
+
+async def archive_batch(table: str, column: str, cutoff: int) -> int:
+    """
+    Move one batch of rows with `column` before `cutoff` to the archive.
+    Returns how many were moved.
+    """
+    rows = await sql.read(f"""
+        SELECT rowid AS _rowid, * FROM {table}
+        WHERE {column} < ?
+        ORDER BY {column}
+        LIMIT ?
+        """, cutoff, config.get("retention.batch"))
+    if not rows:
+        return 0
+    rowids = [row["_rowid"] for row in rows]
+    archived = [{key: row[key] for key in row.keys() if key != "_rowid"} for row in rows]
+
+    # On disk before the rows are deleted, so a crash in between can only
+    # leave them in both places
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, append_archive, table, column, archived)
+
+    async with sql.transact() as con:
+        con.execute(f"""
+            DELETE FROM {table}
+            WHERE {column} < ? AND rowid IN ({", ".join("?" * len(rowids))})
+            """, (cutoff, *rowids))
+    return len(rows)
+
+async def archive_old() -> int:
+    """
+    Archive rows past their age in every table, while it stays quiet.
+    Returns how many were moved.
+    """
+    moved = 0
+    now = datetime.datetime.utcnow()
+    for table, (column, days_key, before_archiving) in ARCHIVED.items():
+        cutoff = discord.utils.time_snowflake(
+            now - datetime.timedelta(days=config.get(days_key)))
+        before_archiving(cutoff)
+        while quiet():
+            count = await archive_batch(table, column, cutoff)
+            moved += count
+            if count < config.get("retention.batch"):
+                break
+    return moved
+
+#
+# Vacuum and statistics
+#
+
+async def incremental_vacuum() -> int:
+    """
+    Give free pages back to the filesystem, a few at a time while it stays
+    quiet. Returns how many were freed.
+    """
+    if sql.query("PRAGMA auto_vacuum")[0][0] != sql.AUTO_VACUUM["incremental"]:
+        return 0
+    freed = 0
+    while quiet():
+        free = sql.query("PRAGMA freelist_count")[0][0]
+        if not free:
+            break
+        # Small steps on the writer, between other writes rather than
+        # alongside them. Not inside anyone's write transaction, though.
+        async with sql.DB_LOCK.write():
+            sql.backend().incremental_vacuum(config.get("retention.vacuum_pages"))
+        step = free - sql.query("PRAGMA freelist_count")[0][0]
+        if step <= 0:
+            break
+        freed += step
+        await asyncio.sleep(0)
+    return freed
+
+def optimize():
+    """
+    Refresh the query planner's statistics where they look out of date
+    """
+    sql.query(f"PRAGMA analysis_limit={config.get('retention.analysis_limit')}")
+    sql.query("PRAGMA optimize")
+
+async def maintain():
+    """
+    One maintenance pass, stopping early if it stops being quiet
+    """
+    started = time.monotonic()
+    moved = await archive_old()
+    freed = 0
+    if quiet():
+        freed = await incremental_vacuum()
+    if quiet():
+        optimize()
+    _L.info("retention: archived %d rows, freed %d pages in %.1fs",
+            moved, freed, time.monotonic() - started)
+
+@setup.task
+async def maintainer():
+    """
+    Do maintenance in quiet periods
+    """
+    while True:
+        await asyncio.sleep(config.get("retention.check_minutes") * 60)
+        await until_quiet()
+        try:
+            await maintain()
+        except Exception: # pylint: disable=broad-except
+            _L.exception("retention: maintenance failed")
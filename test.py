@@ -8,6 +8,7 @@ from discord.ext import commands
 from base import fragment, settings
 
 setup = fragment.Fragment()
+teardown = setup.teardown
 _L = logging.getLogger(__name__)
 
 class LogSettings(settings.SettingBase):
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import asyncio
+import unittest
+
+from base.arlock import RWLock
+
+class CancelledWaiterTest(unittest.TestCase):
+    """
+    Waiters cancelled around the time the lock is handed to them
+    """
+
+    @staticmethod
+    def run_async(coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    @staticmethod
+    async def holder(lock: RWLock, release: asyncio.Event, handoff):
+        """
+        Hold the write lock in a task of its own (so other tasks don't
+        inherit holding it) until `release` is set, then call
+        `handoff(lock.release)` without yielding
+        """
+        await lock.acquire("write")
+        await release.wait()
+        handoff(lock.release)
+
+    def test_cancelled_before_woken(self):
+        async def main():
+            lock = RWLock()
+            release = asyncio.Event()
+            def handoff(unlock):
+                waiter.cancel()
+                unlock()
+            holding = asyncio.ensure_future(self.holder(lock, release, handoff))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(lock.acquire("write"))
+            await asyncio.sleep(0)
+
+            release.set()
+            await holding
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+
+            async with lock.write():
+                pass
+        self.run_async(asyncio.wait_for(main(), 1))
+
+    def test_cancelled_after_woken(self):
+        async def main():
+            lock = RWLock()
+            release = asyncio.Event()
+            def handoff(unlock):
+                unlock()
+                waiter.cancel()
+            holding = asyncio.ensure_future(self.holder(lock, release, handoff))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(lock.acquire("write"))
+            reader = asyncio.ensure_future(lock.acquire("read"))
+            await asyncio.sleep(0)
+
+            release.set()
+            await holding
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+
+            # the reader queued behind it gets the lock instead
+            await reader
+        self.run_async(asyncio.wait_for(main(), 1))
+
+class StatsTest(unittest.TestCase):
+    """
+    Contention statistics
+    """
+
+    @staticmethod
+    def run_async(coro):
+        return asyncio.new_event_loop().run_until_complete(coro)
+
+    def test_uncontended(self):
+        async def main():
+            lock = RWLock()
+            async with lock.read():
+                async with lock.read():
+                    stats = lock.stats()
+                    self.assertEqual(stats["holders"], 1)
+                    self.assertFalse(stats["writer"])
+            async with lock.write():
+                stats = lock.stats()
+                self.assertEqual(stats["holders"], 1)
+                self.assertTrue(stats["writer"])
+
+            stats = lock.stats()
+            # reentrant acquisitions aren't counted again
+            self.assertEqual(stats["acquisitions"], 2)
+            self.assertEqual(stats["contended"], 0)
+            self.assertEqual(stats["wait_total"], 0)
+            self.assertEqual(stats["holders"], 0)
+        self.run_async(asyncio.wait_for(main(), 1))
+
+    def test_queued(self):
+        async def main():
+            lock = RWLock()
+            release = asyncio.Event()
+            async def reader():
+                async with lock.read():
+                    await release.wait()
+            readers = [asyncio.ensure_future(reader()) for _ in range(2)]
+            await asyncio.sleep(0)
+            writer = asyncio.ensure_future(lock.acquire("write"))
+            late = asyncio.ensure_future(lock.acquire("read"))
+            cancelled = asyncio.ensure_future(lock.acquire("read"))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+
+            stats = lock.stats()
+            self.assertEqual(stats["holders"], 2)
+            self.assertEqual(stats["queued_writers"], 1)
+            # the cancelled reader isn't counted, even before it's cleaned up
+            self.assertEqual(stats["queued_readers"], 1)
+
+            await asyncio.sleep(0.01)
+            release.set()
+            await asyncio.gather(*readers)
+            await writer
+
+            stats = lock.stats()
+            self.assertEqual(stats["holders"], 1)
+            self.assertTrue(stats["writer"])
+            self.assertEqual(stats["queued_writers"], 0)
+            self.assertEqual(stats["queued_readers"], 1)
+            self.assertEqual(stats["contended"], 1)
+            self.assertGreater(stats["wait_total"], 0)
+            self.assertEqual(stats["wait_max"], stats["wait_total"])
+            late.cancel()
+        self.run_async(asyncio.wait_for(main(), 1))
+
+if __name__ == "__main__":
+    unittest.main()